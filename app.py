@@ -2,19 +2,39 @@
 from flask import Flask, request, jsonify
 from langchain.vectorstores import Chroma
 from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import RetrievalQA
+from langchain.schema import Document
 import os
 from dotenv import load_dotenv
 load_dotenv()
 import sqlite3
 import stripe
 import requests
+from requests.adapters import HTTPAdapter
+import openai
+import tiktoken
+import numpy as np
+from intent_model import IntentModel, LOCAL_INTENTS, DEFAULT_MODEL_PATH as DEFAULT_INTENT_MODEL_PATH, DEFAULT_THRESHOLD as DEFAULT_INTENT_THRESHOLD
+from build_vector_index import build_unified_index, UNIFIED_COLLECTION_NAME, GENDER_DIRS, DEFAULT_OUTPUT_DIR as DEFAULT_UNIFIED_VECTOR_PATH
+from numpy_vector_index import NumpyVectorIndex, export_index, DEFAULT_INDEX_DIR as DEFAULT_NUMPY_VECTOR_PATH
 import zipfile
 import json
 import re
 import traceback
 import random
+import threading
+import asyncio
+import time
+import uuid
+import hashlib
+import math
+import unicodedata
+from array import array
+from collections import deque, OrderedDict, defaultdict
+from concurrent.futures import CancelledError as FutureCancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait as futures_wait
+from contextlib import asynccontextmanager
 
 app = Flask(__name__)
 
@@ -77,6 +97,134 @@ if not openai_api_key:
     # 開発環境用のダミーキー（実際のAPI呼び出しは失敗します）
     openai_api_key = "dummy_key_for_development"
 
+# 🤖 LLMクライアントのレジストリ（役割ごとに1回だけ生成してスレッド間で共有）
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+# 止まったOpenAI呼び出しを打ち切るまでの秒数
+OPENAI_REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "60"))
+
+# 🧭 ハンドラごとのモデル設定（model / temperature / max_tokens など）
+# LLM_ROUTES_FILE（JSONファイル）や LLM_ROUTES（JSON文字列）でルートごとに上書きできる
+# 例: LLM_ROUTES='{"casual_chat": {"model": "gpt-4o-mini", "max_tokens": 150}}'
+DEFAULT_LLM_ROUTES = {
+    # 意図と質問タイプをまとめて分類（短いJSON）
+    "classify": {"model": "gpt-3.5-turbo", "temperature": 0, "max_tokens": 30},
+    # 慰め・共感（150文字以内）
+    "emotional_support": {
+        "model": "gpt-3.5-turbo",
+        "temperature": 0.8,            # 柔らかく多様な表現に
+        "frequency_penalty": 0.7,      # 同じ表現を避ける
+        "presence_penalty": 0.6,       # 新しい話題を促す
+        "max_tokens": 300,
+    },
+    # 雑談（100文字以内）
+    "casual_chat": {
+        "model": "gpt-3.5-turbo",
+        "temperature": 0.8,
+        "frequency_penalty": 0.7,
+        "presence_penalty": 0.6,
+        "max_tokens": 200,
+    },
+    # 恋愛相談の回答生成（長い回答が途中で切れないよう max_tokens は付けない）
+    "advice": {
+        "model": "gpt-3.5-turbo",
+        "temperature": 0.8,
+        "frequency_penalty": 0.7,
+        "presence_penalty": 0.6,
+    },
+    # RetrievalQAチェーン（ChatOpenAIの既定値）
+    "qa": {},
+}
+
+def load_llm_routes():
+    """既定のルート設定にファイル・環境変数の上書きを重ねる"""
+    routes = {name: dict(config) for name, config in DEFAULT_LLM_ROUTES.items()}
+    overrides = []
+    routes_file = os.getenv("LLM_ROUTES_FILE")
+    if routes_file and os.path.exists(routes_file):
+        with open(routes_file, "r", encoding="utf-8") as f:
+            overrides.append(json.load(f))
+    if os.getenv("LLM_ROUTES"):
+        overrides.append(json.loads(os.getenv("LLM_ROUTES")))
+    for override in overrides:
+        for name, config in override.items():
+            routes.setdefault(name, {}).update(config)
+    return routes
+
+LLM_ROUTES = load_llm_routes()
+
+def llm_route_kwargs(route):
+    """ルート設定をChatOpenAIの引数に変換"""
+    kwargs = dict(LLM_ROUTES[route])
+    if "model" in kwargs:
+        kwargs["model_name"] = kwargs.pop("model")
+    return kwargs
+
+_llm_clients = {}
+_llm_clients_lock = threading.Lock()
+
+# OpenAIへのHTTP接続をプロセス全体で使い回す
+_openai_session = requests.Session()
+_openai_session.mount("https://", HTTPAdapter(pool_connections=OPENAI_POOL_SIZE, pool_maxsize=OPENAI_POOL_SIZE))
+openai.requestssession = _openai_session
+
+def get_llm(route):
+    """ルートに対応するChatOpenAIクライアントを取得（初回だけ生成）"""
+    llm = _llm_clients.get(route)
+    if llm is not None:
+        return llm
+    with _llm_clients_lock:
+        llm = _llm_clients.get(route)
+        if llm is None:
+            llm = ChatOpenAI(openai_api_key=openai_api_key, request_timeout=OPENAI_REQUEST_TIMEOUT, **llm_route_kwargs(route))
+            _llm_clients[route] = llm
+        return llm
+
+# ルートごとの呼び出し回数・レイテンシ・トークン数（tiktokenでの見積もり）
+_llm_route_stats = defaultdict(lambda: {"calls": 0, "errors": 0, "latency": 0.0, "max_latency": 0.0, "prompt_tokens": 0, "completion_tokens": 0})
+_llm_route_stats_lock = threading.Lock()
+
+def record_llm_call(route, started, prompt, completion=None, prompt_tokens=None):
+    """1回のLLM呼び出しの結果を統計に記録（completionがNoneなら失敗、prompt_tokensは数え済みなら渡す）"""
+    latency = time.monotonic() - started
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt)
+    completion_tokens = count_tokens(completion) if completion is not None else 0
+    with _llm_route_stats_lock:
+        stats = _llm_route_stats[route]
+        stats["calls"] += 1
+        stats["errors"] += completion is None
+        stats["latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+
+def invoke_llm(route, prompt, prompt_tokens=None):
+    """ルートのモデルで1回呼び出し、本文を返す"""
+    started = time.monotonic()
+    try:
+        content = get_llm(route).invoke(prompt).content
+    except Exception:
+        record_llm_call(route, started, prompt, prompt_tokens=prompt_tokens)
+        raise
+    record_llm_call(route, started, prompt, content, prompt_tokens)
+    return content
+
+def get_llm_route_stats():
+    with _llm_route_stats_lock:
+        return {
+            route: {
+                "model": LLM_ROUTES.get(route, {}).get("model"),
+                "max_tokens": LLM_ROUTES.get(route, {}).get("max_tokens"),
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "avg_latency": stats["latency"] / stats["calls"] if stats["calls"] else 0.0,
+                "max_latency": stats["max_latency"],
+                "prompt_tokens": stats["prompt_tokens"],
+                "completion_tokens": stats["completion_tokens"]
+            }
+            for route, stats in _llm_route_stats.items()
+        }
+
 # 💾 データベースパス設定（環境に応じて切り替え）
 DB_PATH = os.getenv("DB_PATH", "/data/user_data.db")  # 本番環境では永続ディスクを使用
 
@@ -2519,6 +2667,8 @@ mapping = [
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    # Webhookワーカーとリクエスト処理が同時に書き込むためWALモードにする
+    cursor.execute("PRAGMA journal_mode=WAL")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id TEXT PRIMARY KEY,
@@ -2552,6 +2702,84 @@ def init_db():
             customer_id TEXT
         )
     ''')
+    # LINE Webhookイベントの永続キュー
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            event TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            claimed_by TEXT,
+            created_at REAL,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_queue_status ON webhook_queue (status, id)")
+    # 処理済みWebhookイベントID（LINEの再送を弾くため）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_webhook_events (
+            event_id TEXT PRIMARY KEY,
+            seen_at REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_webhook_events_seen_at ON processed_webhook_events (seen_at)")
+    # LINEプッシュ送信のアウトボックス（状態変更と同じトランザクションで書き込む）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS line_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            messages TEXT,
+            retry_key TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            claimed_by TEXT,
+            created_at REAL,
+            updated_at REAL,
+            delivered_at REAL,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_line_outbox_status ON line_outbox (status, next_attempt_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_line_outbox_user ON line_outbox (user_id, id)")
+    # 恋愛相談の回答キャッシュ（質問の埋め込みで類似検索）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            profile_key TEXT,
+            question_type TEXT,
+            question TEXT,
+            embedding BLOB,
+            answer TEXT,
+            tokens INTEGER,
+            hits INTEGER DEFAULT 0,
+            created_at REAL,
+            last_used_at REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_key ON answer_cache (profile_key, question_type)")
+    # 分類結果のメモ（正規化したメッセージ → 分類結果）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS classification_cache (
+            kind TEXT,
+            text_key TEXT,
+            result TEXT,
+            updated_at REAL,
+            PRIMARY KEY (kind, text_key)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_classification_cache_updated_at ON classification_cache (updated_at)")
+    # 埋め込みのキャッシュ（モデル名 + 正規化したテキストのハッシュ → float32ベクトル）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            text_key TEXT PRIMARY KEY,
+            model TEXT,
+            embedding BLOB,
+            created_at REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_created_at ON embedding_cache (created_at)")
     conn.commit()
     conn.close()
     print("SQLiteデータベースを初期化しました。")
@@ -2671,27 +2899,34 @@ def process_mbti_answer(user_id, answer, user_profile):
         print(f"全回答履歴: {answers}")
         print(f"==================")
         cursor.execute("UPDATE users SET mbti_answers=? WHERE user_id=?", (json.dumps(answers), user_id))
-        conn.commit()
-        conn.close()
         next_question_index = len(answers)
         print(f"next_question_index: {next_question_index}")
         if next_question_index < 16:
             print(f"次の質問を送信: 質問{next_question_index + 1}/16")
-            return send_mbti_question(user_id, next_question_index)
+            next_question = send_mbti_question(user_id, next_question_index)
+            # 回答の保存と次の質問の送信予約を同じトランザクションで書く
+            stage_line_messages(cursor, user_id, next_question)
+            conn.commit()
+            conn.close()
+            return next_question
         else:
+            conn.commit()
+            conn.close()
             print(f"診断完了！全回答: {answers}")
             result_message = complete_mbti_diagnosis(user_id, answers)
             payment_message = get_payment_message(user_id)
+            completion_messages = [
+                {"type": "text", "text": result_message},
+                {"type": "text", "text": payment_message}
+            ]
             # 診断完了メッセージ送信後にmodeをリセット
             conn = sqlite3.connect(DB_PATH)
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET mode='' WHERE user_id=?", (user_id,))
+            stage_line_messages(cursor, user_id, completion_messages)
             conn.commit()
             conn.close()
-            return [
-                {"type": "text", "text": result_message},
-                {"type": "text", "text": payment_message}
-            ]
+            return completion_messages
 
     except Exception as e:
         print(f"MBTI回答処理エラー: {e}")
@@ -2939,135 +3174,720 @@ def process_user_message(user_id, message, user_profile):
         traceback.print_exc()
         return "エラーが発生したよ😅 もう一度お試ししてね！"
 
-# LINEリプライ送信関数
-def send_line_reply(reply_token, message):
-    """LINEにリプライメッセージを送信"""
-    try:
-        print(f"Sending LINE reply with token: {reply_token}")
-        print(f"Message content: {message}")
-        
+# 📡 LINE Messaging APIクライアント（接続プール + リトライ + レート制限）
+LINE_API_BASE_URL = "https://api.line.me/v2/bot"
+LINE_API_CONNECT_TIMEOUT = float(os.getenv("LINE_API_CONNECT_TIMEOUT", "3"))
+LINE_API_READ_TIMEOUT = float(os.getenv("LINE_API_READ_TIMEOUT", "10"))
+LINE_API_MAX_RETRIES = int(os.getenv("LINE_API_MAX_RETRIES", "3"))
+LINE_API_POOL_SIZE = int(os.getenv("LINE_API_POOL_SIZE", "10"))
+# LINEのレート制限（送信系APIは2,000リクエスト/秒）より少し余裕を持たせる
+LINE_API_RATE_LIMIT = float(os.getenv("LINE_API_RATE_LIMIT", "1500"))
+LINE_API_RATE_BURST = int(os.getenv("LINE_API_RATE_BURST", "100"))
+
+class TokenBucket:
+    """トークンバケット方式のレートリミッタ"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得できるまで待つ"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class LineClient:
+    """keep-aliveセッションを共有するLINE Messaging APIクライアント"""
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=LINE_API_POOL_SIZE, pool_maxsize=LINE_API_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.limiter = TokenBucket(LINE_API_RATE_LIMIT, LINE_API_RATE_BURST)
+        self.timeout = (LINE_API_CONNECT_TIMEOUT, LINE_API_READ_TIMEOUT)
+
+    def _post(self, path, payload, retry_key=None):
         line_token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
         if not line_token:
             print("⚠️ LINE_CHANNEL_ACCESS_TOKENが設定されていません")
-            return
-        
-        url = "https://api.line.me/v2/bot/message/reply"
+            return None
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {line_token}"
         }
+        if retry_key:
+            # 同じリトライキーの再送はLINE側で重複配信されない
+            headers["X-Line-Retry-Key"] = retry_key
+        url = f"{LINE_API_BASE_URL}{path}"
+        for attempt in range(LINE_API_MAX_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.post(url, headers=headers, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= LINE_API_MAX_RETRIES:
+                    raise
+                print(f"⚠️ LINE API接続エラー（再試行 {attempt + 1}/{LINE_API_MAX_RETRIES}）: {e}")
+                time.sleep(self._backoff(attempt))
+                continue
+            if response.status_code not in self.RETRY_STATUS or attempt >= LINE_API_MAX_RETRIES:
+                return response
+            print(f"⚠️ LINE API {response.status_code}（再試行 {attempt + 1}/{LINE_API_MAX_RETRIES}）")
+            time.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+        return response
+
+    def _backoff(self, attempt, retry_after=None):
+        """指数バックオフ + ジッター（Retry-Afterがあれば優先）"""
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(8.0, 0.5 * (2 ** attempt)))
+
+    def reply(self, reply_token, messages):
+        return self._post("/message/reply", {"replyToken": reply_token, "messages": messages})
+
+    def push(self, to, messages, retry_key=None):
+        return self._post("/message/push", {"to": to, "messages": messages}, retry_key=retry_key or str(uuid.uuid4()))
+
+line_client = LineClient()
+
+def to_line_messages(message):
+    """文字列・テンプレート・配列をLINEのmessages配列に変換"""
+    # メッセージが配列の場合は複数メッセージ
+    if isinstance(message, list):
+        return [m if isinstance(m, dict) else {"type": "text", "text": str(m)} for m in message]
+    # メッセージが辞書（テンプレート）の場合はそのまま使用
+    if isinstance(message, dict):
+        return [message]
+    # 文字列の場合は通常のテキストメッセージ
+    return [{"type": "text", "text": message}]
+
+# LINEリプライ送信関数
+def send_line_reply(reply_token, message):
+    """LINEにリプライメッセージを送信"""
+    try:
+        print(f"Sending LINE reply with token: {reply_token}")
+        print(f"Message content: {message}")
         
-        # メッセージが配列の場合は複数メッセージ
-        if isinstance(message, list):
-            data = {
-                "replyToken": reply_token,
-                "messages": message
-            }
-        # メッセージが辞書（テンプレート）の場合はそのまま使用
-        elif isinstance(message, dict):
-            data = {
-                "replyToken": reply_token,
-                "messages": [message]
-            }
-        else:
-            # 文字列の場合は通常のテキストメッセージ
-            data = {
-                "replyToken": reply_token,
-                "messages": [{"type": "text", "text": message}]
-            }
-        
-        print(f"Sending request to LINE API: {url}")
-        response = requests.post(url, headers=headers, json=data)
+        response = line_client.reply(reply_token, to_line_messages(message))
+        if response is None:
+            return False
         print(f"LINE API response status: {response.status_code}")
         print(f"LINE API response: {response.text}")
         
         if response.status_code != 200:
             print(f"⚠️ LINE API error: {response.status_code} - {response.text}")
+            return False
+        return True
         
     except Exception as e:
         print(f"LINE送信エラー: {e}")
+        return False
+
+# 📮 LINEプッシュ送信のアウトボックス（永続化 + バックグラウンド送信）
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2.0"))
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "120"))
+# リプライで届くはずのメッセージをプッシュに切り替えるまでの猶予（秒）
+OUTBOX_REPLY_GRACE = float(os.getenv("OUTBOX_REPLY_GRACE", "30"))
+# プッシュの並列送信数（同じユーザーの行は取得時に1件ずつに絞られるので順序は保たれる）
+OUTBOX_SENDER_WORKERS = int(os.getenv("OUTBOX_SENDER_WORKERS", "4"))
+
+_outbox_wakeup = threading.Event()
+_outbox_sender = None
+_outbox_sender_lock = threading.Lock()
+_outbox_last_purge = 0.0
+_outbox_executor = ThreadPoolExecutor(max_workers=OUTBOX_SENDER_WORKERS, thread_name_prefix="line-outbox-send")
+_outbox_inflight = 0
+_outbox_inflight_cond = threading.Condition()
 
-def classify_intent(message):
-    """メッセージの意図を分類"""
+def enqueue_line_push(user_id, message, cursor=None, delay=0):
+    """プッシュメッセージをアウトボックスに書き込む（cursorを渡すと呼び出し元のトランザクションに含める）"""
+    messages = to_line_messages(message)
+    now = time.time()
+    rows = [
+        (user_id, json.dumps(messages[i:i + LINE_MAX_MESSAGES_PER_REQUEST], ensure_ascii=False),
+         str(uuid.uuid4()), now + delay, now, now)
+        for i in range(0, len(messages), LINE_MAX_MESSAGES_PER_REQUEST)
+    ]
+    own_conn = None
+    if cursor is None:
+        own_conn = sqlite3.connect(DB_PATH, timeout=30)
+        cursor = own_conn.cursor()
+    ids = []
+    for row in rows:
+        cursor.execute(
+            "INSERT INTO line_outbox (user_id, messages, retry_key, status, next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            row
+        )
+        ids.append(cursor.lastrowid)
+    if own_conn is not None:
+        own_conn.commit()
+        own_conn.close()
+        if delay <= 0:
+            _outbox_wakeup.set()
+    return ids
+
+def lease_line_outbox(outbox_ids):
+    """リプライで送る予定の控えの行を、送信スレッドに取られる前に押さえる（押さえた行のIDを返す）"""
+    now = time.time()
+    leased = set()
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
     try:
-        if not openai_api_key or openai_api_key == "dummy_key_for_development":
-            print("⚠️ OpenAI APIキーが設定されていません")
-            return 9  # デフォルトは「その他」
-        
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.8,            # 柔らかく多様な表現に
-            frequency_penalty=0.7,      # 同じ表現を避ける
-            presence_penalty=0.6,       # 新しい話題を促す
-            openai_api_key=openai_api_key
+        cursor.execute("BEGIN IMMEDIATE")
+        for outbox_id in outbox_ids:
+            cursor.execute(
+                "UPDATE line_outbox SET status='replying', updated_at=? WHERE id=? AND status='pending'",
+                (now, outbox_id)
+            )
+            if cursor.rowcount:
+                leased.add(outbox_id)
+        cursor.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return leased
+
+def settle_line_outbox(delivered_ids=(), cancelled_ids=(), released_ids=(), push_user_id=None, push_messages=None):
+    """押さえていた控えの行を、リプライで届いた分は送信済み・積み直す分はキャンセル・未送信の分はすぐ送信に戻す"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    now = time.time()
+    cursor.executemany(
+        "UPDATE line_outbox SET status='delivered', delivered_at=?, updated_at=? WHERE id=? AND status='replying'",
+        [(now, now, outbox_id) for outbox_id in delivered_ids]
+    )
+    cursor.executemany(
+        "UPDATE line_outbox SET status='cancelled', updated_at=? WHERE id=? AND status='replying'",
+        [(now, outbox_id) for outbox_id in cancelled_ids]
+    )
+    cursor.executemany(
+        "UPDATE line_outbox SET status='pending', next_attempt_at=?, updated_at=? WHERE id=? AND status='replying'",
+        [(now, now, outbox_id) for outbox_id in released_ids]
+    )
+    if push_messages:
+        enqueue_line_push(push_user_id, push_messages, cursor=cursor)
+    conn.commit()
+    conn.close()
+    if push_messages or released_ids:
+        _outbox_wakeup.set()
+
+# LINEプッシュ送信関数
+def claim_line_outbox(claimed_by, limit):
+    """送信期限が来たアウトボックスの行を取得（ユーザーごとに古いものから1件ずつ）"""
+    now = time.time()
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        # 送信中・リプライ待ちのまま止まった行（プロセスが落ちた等）は送り直す
+        cursor.execute(
+            "UPDATE line_outbox SET status='pending', claimed_by=NULL WHERE status IN ('sending', 'replying') AND updated_at < ?",
+            (now - OUTBOX_CLAIM_TIMEOUT,)
         )
-        prompt = (
-            "Classify the following message into one of these categories:\n"
-            "1: Greeting (hello, hi, good morning, good evening, こんにちは, こんばんは, おはよう, おやすみ, おはよ, etc.)\n"
-            "2: Thanks (thank you, thanks, ありがとう, どうも, etc.)\n"
-            "3: Short reply (ok, yes, got it, わかった, うん, はい, 了解, etc.)\n"
-            "4: Love advice (questions about love, dating, relationships, 恋愛, 相手, デート, 告白, etc.)\n"
-            "5: Casual chat (weather, hobbies, daily conversation, 天気, 趣味, 日常会話, 仕事, 学校, ニュース, 映画, 音楽, 食べ物, etc.)\n"
-            "6: General questions (general knowledge, how to, what is, why, 勉強, 知識, 方法, 理由, etc.)\n"
-            "7: Personal advice (life advice, career, study, health, 人生相談, キャリア, 健康, etc.)\n"
-            "8: Entertainment (jokes, fun, games, 冗談, 遊び, ゲーム, etc.)\n"
-            "9: Other\n"
-            "Return only the number (1-9)."
+        cursor.execute(
+            """SELECT id, user_id, messages, retry_key FROM line_outbox o
+               WHERE status='pending' AND next_attempt_at <= ?
+                 AND NOT EXISTS (
+                     SELECT 1 FROM line_outbox p
+                     WHERE p.user_id = o.user_id AND p.id < o.id AND p.status IN ('pending', 'sending', 'replying')
+                 )
+               ORDER BY id LIMIT ?""",
+            (now, limit)
         )
-        
-        response = llm.invoke(f"{prompt}\n\nMessage: {message}")
-        result = int(response.content.strip())
-        
-        # デバッグログを追加
-        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write(f"[classify_intent] message: {message}, response: {response.content}, result: {result}\n")
-        
-        return result
+        rows = cursor.fetchall()
+        cursor.executemany(
+            "UPDATE line_outbox SET status='sending', claimed_by=?, attempts=attempts+1, updated_at=? WHERE id=?",
+            [(claimed_by, now, row[0]) for row in rows]
+        )
+        cursor.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+def _finish_line_outbox(outbox_id, delivered, retryable, error=None):
+    """送信結果をアウトボックスに反映（失敗時はバックオフして再試行）"""
+    now = time.time()
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    if delivered:
+        cursor.execute(
+            "UPDATE line_outbox SET status='delivered', delivered_at=?, updated_at=?, claimed_by=NULL WHERE id=?",
+            (now, now, outbox_id)
+        )
+    else:
+        cursor.execute("SELECT attempts FROM line_outbox WHERE id=?", (outbox_id,))
+        row = cursor.fetchone()
+        attempts = row[0] if row else OUTBOX_MAX_ATTEMPTS
+        if retryable and attempts < OUTBOX_MAX_ATTEMPTS:
+            backoff = min(300.0, 2.0 * (2 ** attempts)) * random.uniform(0.5, 1.0)
+            cursor.execute(
+                "UPDATE line_outbox SET status='pending', next_attempt_at=?, updated_at=?, claimed_by=NULL, last_error=? WHERE id=?",
+                (now + backoff, now, error, outbox_id)
+            )
+        else:
+            cursor.execute(
+                "UPDATE line_outbox SET status='failed', updated_at=?, claimed_by=NULL, last_error=? WHERE id=?",
+                (now, error, outbox_id)
+            )
+    conn.commit()
+    conn.close()
+
+def _deliver_line_outbox_row(outbox_id, user_id, messages, retry_key):
+    """アウトボックスの1行をLINEにプッシュ送信"""
+    try:
+        response = line_client.push(user_id, messages, retry_key=retry_key)
+    except Exception as e:
+        print(f"❌ アウトボックス送信エラー: id={outbox_id}, error={e}")
+        _finish_line_outbox(outbox_id, False, True, str(e))
+        return
+    if response is None:
+        _finish_line_outbox(outbox_id, False, True, "LINE_CHANNEL_ACCESS_TOKEN not set")
+    # 409は同じリトライキーで既に受け付け済み
+    elif response.status_code in (200, 409):
+        print(f"✅ プッシュ送信済み: id={outbox_id}, user_id={user_id}")
+        _finish_line_outbox(outbox_id, True, False)
+    else:
+        retryable = response.status_code in LineClient.RETRY_STATUS
+        print(f"⚠️ プッシュ送信失敗: id={outbox_id}, status={response.status_code}, body={response.text}")
+        _finish_line_outbox(outbox_id, False, retryable, f"{response.status_code}: {response.text}")
+
+def _purge_line_outbox():
+    """送信済み・キャンセル済みの古い行を削除"""
+    global _outbox_last_purge
+    now = time.time()
+    if now - _outbox_last_purge < 3600:
+        return
+    _outbox_last_purge = now
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute(
+        "DELETE FROM line_outbox WHERE status IN ('delivered', 'cancelled') AND updated_at < ?",
+        (now - 7 * 24 * 60 * 60,)
+    )
+    conn.commit()
+    conn.close()
+
+def _deliver_line_outbox_row_in_slot(*row):
+    global _outbox_inflight
+    try:
+        _deliver_line_outbox_row(*row)
     except Exception as e:
+        print(f"❌ アウトボックス送信エラー: id={row[0]}, error={e}")
+    finally:
+        with _outbox_inflight_cond:
+            _outbox_inflight -= 1
+            _outbox_inflight_cond.notify()
+        # 同じユーザーの次の行をすぐ取得できるように起こす
+        _outbox_wakeup.set()
+
+def _outbox_sender_loop():
+    """アウトボックスの送信期限が来た行を取得し、空いている送信ワーカーに渡し続ける"""
+    global _outbox_inflight
+    claimed_by = f"outbox-{WEBHOOK_PROCESS_TAG}"
+    while True:
+        with _outbox_inflight_cond:
+            while _outbox_inflight >= OUTBOX_SENDER_WORKERS:
+                _outbox_inflight_cond.wait()
+            free = OUTBOX_SENDER_WORKERS - _outbox_inflight
+        _outbox_wakeup.clear()
+        try:
+            _purge_line_outbox()
+            rows = claim_line_outbox(claimed_by, min(OUTBOX_BATCH_SIZE, free))
+        except Exception as e:
+            print(f"❌ アウトボックス取得エラー: {e}")
+            time.sleep(OUTBOX_POLL_INTERVAL)
+            continue
+        if not rows:
+            _outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+            continue
+        for row in rows:
+            with _outbox_inflight_cond:
+                _outbox_inflight += 1
+            _outbox_executor.submit(_deliver_line_outbox_row_in_slot, *row)
+
+def start_outbox_sender():
+    """アウトボックス送信スレッドを起動（複数回呼んでも1回だけ起動）"""
+    global _outbox_sender
+    with _outbox_sender_lock:
+        if _outbox_sender is not None:
+            return
+        _outbox_sender = threading.Thread(target=_outbox_sender_loop, name="line-outbox", daemon=True)
+        _outbox_sender.start()
+        print(f"✅ LINEアウトボックス送信スレッドを起動しました（並列数: {OUTBOX_SENDER_WORKERS}）")
+
+def get_outbox_stats():
+    """アウトボックスの状態別件数を取得"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM line_outbox GROUP BY status")
+    stats = dict(cursor.fetchall())
+    conn.close()
+    return stats
+
+# 📦 1イベント分の送信メッセージをまとめて1回のリプライで送る
+LINE_MAX_MESSAGES_PER_REQUEST = 5
+
+class OutboundBatch:
+    """1つのイベントで生成したメッセージを集め、リプライ1回（足りなければプッシュ）で送信する"""
+
+    def __init__(self, reply_token, user_id):
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self.messages = []
+        self.reply_used = False
+        # 状態変更と一緒にアウトボックスへ控えを書いた (行ID, メッセージ)（リプライで届けば送信済みにする）
+        self.staged_outbox = []
+        # 締め切り超過時は生成スレッドからも送信するので、送信順を保つために直列化する
+        self.lock = threading.RLock()
+
+    def add(self, message):
+        if message:
+            with self.lock:
+                self.messages.extend(to_line_messages(message))
+
+    def stream(self, bubble):
+        """ストリーミングの吹き出しを追加（最初の1つはすぐリプライし、以降はプッシュ1回分溜まるごとに送る）"""
+        with self.lock:
+            self.add(bubble)
+            if (self.reply_token and not self.reply_used) or len(self.messages) >= LINE_MAX_MESSAGES_PER_REQUEST:
+                self._flush()
+
+    def flush(self):
+        """溜まっているメッセージを送信（リプライトークンは1回しか使わない）"""
+        with self.lock:
+            return self._flush()
+
+    def send_if_unreplied(self, message):
+        """まだ何もリプライしていなければmessageをリプライで送る（送ったらTrue）"""
+        with self.lock:
+            if self.reply_used:
+                return False
+            self.add(message)
+            self.flush()
+            return True
+
+    def _flush(self):
+        pending, self.messages = self.messages, []
+        staged, self.staged_outbox = self.staged_outbox, []
+        if not pending and not staged:
+            return True
+        leased = set()
+        if staged:
+            try:
+                leased = lease_line_outbox([outbox_id for outbox_id, _ in staged])
+            except Exception as e:
+                print(f"❌ アウトボックス確保エラー: {e}")
+        for outbox_id, run in staged:
+            # 猶予切れで送信スレッドが取得済みの控えはプッシュに任せ、リプライからは外す
+            index = -1 if outbox_id in leased else _find_message_run(pending, run)
+            if index >= 0:
+                del pending[index:index + len(run)]
+        sent = []
+        if not self.reply_used and self.reply_token and pending:
+            head = pending[:LINE_MAX_MESSAGES_PER_REQUEST]
+            pending = pending[LINE_MAX_MESSAGES_PER_REQUEST:]
+            self.reply_used = True
+            if send_line_reply(self.reply_token, head):
+                sent = head
+            else:
+                # リプライトークンが失効している等の場合はプッシュで届ける
+                print("⚠️ リプライに失敗したためプッシュで送信します")
+                pending = head + pending
+        delivered, cancelled, released = [], [], []
+        for outbox_id, run in staged:
+            if outbox_id not in leased:
+                continue
+            if _find_message_run(sent, run) >= 0:
+                delivered.append(outbox_id)
+            elif _find_message_run(sent + pending, run) >= 0:
+                # 残り（またはすべて）はこの後のプッシュに含まれる
+                cancelled.append(outbox_id)
+            else:
+                # バッチに積まれなかった控えはそのまま送る
+                released.append(outbox_id)
+        try:
+            settle_line_outbox(delivered, cancelled, released, self.user_id, pending)
+            return True
+        except Exception as e:
+            print(f"LINEプッシュ送信エラー: {e}")
+            return False
+
+def _find_message_run(messages, run):
+    """messagesの中でrunが連続して現れる位置（無ければ-1）"""
+    for i in range(len(messages) - len(run) + 1):
+        if messages[i:i + len(run)] == run:
+            return i
+    return -1
+
+_event_context = threading.local()
+
+def current_outbound_batch():
+    """処理中のイベントの送信バッチを取得（イベント処理外ならNone）"""
+    return getattr(_event_context, "batch", None)
+
+def stage_line_messages(cursor, user_id, message):
+    """状態変更と同じトランザクションで送信予定のメッセージをアウトボックスに控えておく"""
+    batch = current_outbound_batch()
+    if batch is None or batch.user_id != user_id:
+        return
+    # リプライが届けば送信済みになり、プロセスが落ちた場合は猶予後にプッシュされる
+    messages = to_line_messages(message)
+    outbox_ids = enqueue_line_push(user_id, messages, cursor=cursor, delay=OUTBOX_REPLY_GRACE)
+    for i, outbox_id in enumerate(outbox_ids):
+        start = i * LINE_MAX_MESSAGES_PER_REQUEST
+        batch.staged_outbox.append((outbox_id, messages[start:start + LINE_MAX_MESSAGES_PER_REQUEST]))
+
+# 📝 分類結果のメモ化（正規化したテキストの完全一致）
+CLASSIFICATION_MEMO_SIZE = int(os.getenv("CLASSIFICATION_MEMO_SIZE", "5000"))
+# SQLiteに残す分類結果の保持期間（秒）。古い行は1時間ごとに削除する
+CLASSIFICATION_MEMO_TTL = float(os.getenv("CLASSIFICATION_MEMO_TTL", str(30 * 24 * 60 * 60)))
+
+# 異体字セレクタ・ゼロ幅接合子（絵文字そのものは意味があるので残す）
+_EMOJI_JOINER_RE = re.compile("[\uFE0E\uFE0F\u200D]+")
+
+def normalize_message_key(text):
+    """メモのキー用にメッセージを正規化（NFKC・小文字化・異体字セレクタの除去・空白の統一）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _EMOJI_JOINER_RE.sub("", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+class ClassificationMemo:
+    """分類結果のLRUメモ（SQLiteに書き込んでプロセス間・再起動後も共有）"""
+
+    def __init__(self, max_size, ttl=CLASSIFICATION_MEMO_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._last_purge = 0.0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, kind, text):
+        key = (kind, normalize_message_key(text))
+        if not key[1]:
+            return None
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self._memory[key]
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            cursor = conn.cursor()
+            cursor.execute("SELECT result FROM classification_cache WHERE kind=? AND text_key=?", key)
+            row = cursor.fetchone()
+            conn.close()
+        except Exception as e:
+            print(f"❌ 分類メモ読み込みエラー: {e}")
+            row = None
+        with self._lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            result = json.loads(row[0])
+            self.stats["db_hits"] += 1
+            self._remember(key, result)
+            return result
+
+    def put(self, kind, text, result):
+        key = (kind, normalize_message_key(text))
+        if not key[1]:
+            return
+        with self._lock:
+            self._remember(key, result)
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO classification_cache (kind, text_key, result, updated_at) VALUES (?, ?, ?, ?)",
+                (kind, key[1], json.dumps(result), now)
+            )
+            if now - self._last_purge >= 3600:
+                self._last_purge = now
+                conn.execute("DELETE FROM classification_cache WHERE updated_at < ?", (now - self.ttl,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"❌ 分類メモ書き込みエラー: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, size=len(self._memory))
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+classification_memo = ClassificationMemo(CLASSIFICATION_MEMO_SIZE)
+
+# ⚡ 意図分類のローカル高速判定（自信がある時だけLLMを省略）
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", DEFAULT_INTENT_MODEL_PATH)
+INTENT_FAST_PATH_THRESHOLD = float(os.getenv("INTENT_FAST_PATH_THRESHOLD", str(DEFAULT_INTENT_THRESHOLD)))
+
+_intent_model = None
+_intent_model_lock = threading.Lock()
+_intent_fast_path_stats = {"local_hits": 0, "llm_fallbacks": 0}
+
+def load_intent_model():
+    """学習済みのローカル意図分類モデルを読み込む（なければNone）"""
+    global _intent_model
+    with _intent_model_lock:
+        if os.path.exists(INTENT_MODEL_PATH):
+            try:
+                _intent_model = IntentModel.load(INTENT_MODEL_PATH)
+                print(f"ローカル意図分類モデルを読み込みました: {INTENT_MODEL_PATH}")
+            except Exception as e:
+                print(f"❌ ローカル意図分類モデル読み込みエラー: {e}")
+                _intent_model = None
+        return _intent_model
+
+def classify_intent_locally(message):
+    """ローカルモデルで自信を持って判定できる意図（1-3, 5）ならその番号、それ以外はNone"""
+    model = _intent_model
+    if model is None:
+        return None
+    intent, prob = model.predict(message)
+    if intent in LOCAL_INTENTS and prob >= INTENT_FAST_PATH_THRESHOLD:
         with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write(f"[classify_intent] error: {e}\n")
-        return 9  # デフォルトは「その他」
+            f.write(f"[classify_intent_locally] message: {message}, intent: {intent}, prob: {prob:.3f}\n")
+        return intent
+    return None
 
-def classify_question_type(question):
-    """質問のタイプを詳細に分類"""
+def try_fast_path_classification(message):
+    """ローカル判定を試して統計に記録（判定できなければNone）"""
+    intent = classify_intent_locally(message)
+    with _intent_model_lock:
+        _intent_fast_path_stats["local_hits" if intent is not None else "llm_fallbacks"] += 1
+    return intent
+
+def classify_message_fast(message):
+    """ローカル判定を先に試し、判定できなければLLMで意図と質問タイプを分類"""
+    intent = try_fast_path_classification(message)
+    if intent is not None:
+        return intent, 9
+    return classify_message(message)
+
+def get_intent_fast_path_stats():
+    """ローカル判定のヒット率を取得"""
+    with _intent_model_lock:
+        stats = dict(_intent_fast_path_stats)
+    total = stats["local_hits"] + stats["llm_fallbacks"]
+    stats["hit_rate"] = round(stats["local_hits"] / total, 4) if total else 0.0
+    stats["model_loaded"] = _intent_model is not None
+    return stats
+
+load_intent_model()
+
+# 質問タイプ番号（1-9）と名前の対応
+QUESTION_TYPES = [
+    "方法論・アプローチ",
+    "原因分析・理由説明",
+    "タイミング・時期",
+    "場所・デートプラン",
+    "具体的な内容・アイデア",
+    "感情・心理",
+    "LINE・メッセージ",
+    "関係性・告白",
+    "一般的な相談"
+]
+
+CLASSIFY_MESSAGE_PROMPT = (
+    "Classify the following message in two ways.\n"
+    "\n"
+    "intent (one of):\n"
+    "1: Greeting (hello, hi, good morning, good evening, こんにちは, こんばんは, おはよう, おやすみ, おはよ, etc.)\n"
+    "2: Thanks (thank you, thanks, ありがとう, どうも, etc.)\n"
+    "3: Short reply (ok, yes, got it, わかった, うん, はい, 了解, etc.)\n"
+    "4: Love advice (questions about love, dating, relationships, 恋愛, 相手, デート, 告白, etc.)\n"
+    "5: Casual chat (weather, hobbies, daily conversation, 天気, 趣味, 日常会話, 仕事, 学校, ニュース, 映画, 音楽, 食べ物, etc.)\n"
+    "6: General questions (general knowledge, how to, what is, why, 勉強, 知識, 方法, 理由, etc.)\n"
+    "7: Personal advice (life advice, career, study, health, 人生相談, キャリア, 健康, etc.)\n"
+    "8: Entertainment (jokes, fun, games, 冗談, 遊び, ゲーム, etc.)\n"
+    "9: Other\n"
+    "\n"
+    "question_type (one of):\n"
+    "1: 方法論・アプローチ (どうやって、どのように、方法、アプローチ、戦略)\n"
+    "2: 原因分析・理由説明 (なぜ、理由、原因、どうして)\n"
+    "3: タイミング・時期 (いつ、時期、タイミング、時期)\n"
+    "4: 場所・デートプラン (どこで、場所、デート、プラン)\n"
+    "5: 具体的な内容・アイデア (何を、内容、アイデア、提案)\n"
+    "6: 感情・心理 (気持ち、感情、心理、不安)\n"
+    "7: LINE・メッセージ (LINE、メッセージ、文例、返信)\n"
+    "8: 関係性・告白 (関係、告白、距離、親密度)\n"
+    "9: 一般的な相談 (全般、総合、アドバイス)\n"
+    "\n"
+    'Return only JSON like {"intent": 4, "question_type": 7}.'
+)
+
+def classify_message(message):
+    """メッセージの意図（1-9）と質問タイプ（1-9）を1回のLLM呼び出しでまとめて分類"""
     try:
+        cached = classification_memo.get("message", message)
+        if cached is not None:
+            return tuple(cached)
+        
         if not openai_api_key or openai_api_key == "dummy_key_for_development":
             print("⚠️ OpenAI APIキーが設定されていません")
-            return 9  # デフォルトは「一般的な相談」
+            return 9, 9  # デフォルトは「その他」「一般的な相談」
         
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.8,            # 柔らかく多様な表現に
-            frequency_penalty=0.7,      # 同じ表現を避ける
-            presence_penalty=0.6,       # 新しい話題を促す
-            openai_api_key=openai_api_key
-        )
-        prompt = (
-            "以下の質問を最も適切なカテゴリに分類してください：\n"
-            "1: 方法論・アプローチ (どうやって、どのように、方法、アプローチ、戦略)\n"
-            "2: 原因分析・理由説明 (なぜ、理由、原因、どうして)\n"
-            "3: タイミング・時期 (いつ、時期、タイミング、時期)\n"
-            "4: 場所・デートプラン (どこで、場所、デート、プラン)\n"
-            "5: 具体的な内容・アイデア (何を、内容、アイデア、提案)\n"
-            "6: 感情・心理 (気持ち、感情、心理、不安)\n"
-            "7: LINE・メッセージ (LINE、メッセージ、文例、返信)\n"
-            "8: 関係性・告白 (関係、告白、距離、親密度)\n"
-            "9: 一般的な相談 (全般、総合、アドバイス)\n"
-            "数字のみで回答してください。"
-        )
-        
-        response = llm.invoke(f"{prompt}\n\n質問: {question}")
-        result = int(response.content.strip())
-        
-        # デバッグログを追加
-        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write(f"[classify_question_type] question: {question}, response: {response.content}, result: {result}\n")
-        
-        return result
+        content = invoke_llm("classify", f"{CLASSIFY_MESSAGE_PROMPT}\n\nMessage: {message}")
+        return record_classification(message, content)
     except Exception as e:
         with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write(f"[classify_question_type] error: {e}\n")
-        return 9  # デフォルトは「一般的な相談」
+            f.write(f"[classify_message] error: {e}\n")
+        return 9, 9  # デフォルトは「その他」「一般的な相談」
+
+def record_classification(message, content):
+    """LLMの分類結果を解釈し、ログとメモに残す"""
+    intent, question_type = parse_classification(content)
+    
+    # デバッグログを追加
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[classify_message] message: {message}, response: {content}, intent: {intent}, question_type: {question_type}\n")
+    
+    classification_memo.put("message", message, [intent, question_type])
+    return intent, question_type
+
+def parse_classification(content):
+    """分類結果のJSON（崩れていれば数字2つ）から意図と質問タイプを取り出す"""
+    try:
+        data = json.loads(content.strip().strip("`").removeprefix("json").strip())
+        intent = int(data.get("intent", 9))
+        question_type = int(data.get("question_type", 9))
+    except (ValueError, TypeError, AttributeError):
+        numbers = [int(n) for n in re.findall(r"\d", content)]
+        intent = numbers[0] if len(numbers) > 0 else 9
+        question_type = numbers[1] if len(numbers) > 1 else 9
+    return (intent if 1 <= intent <= 9 else 9), (question_type if 1 <= question_type <= 9 else 9)
 
 def analyze_chat_history(history, user_profile):
     """チャット履歴を分析して洞察を提供"""
@@ -3219,6 +4039,19 @@ def generate_compatibility_strategy(user_mbti, target_mbti, compatibility_notes)
     except Exception as e:
         return "相性に基づく戦略を生成中だよ！"
 
+def build_emotional_support_prompt(message, user_profile):
+    """慰め・共感用のプロンプトを作成"""
+    return (
+        f"あなたはMBTI診断ベースの女性の恋愛マスターの友達だよ。\n"
+        f"ユーザー情報: あなたのMBTI: {user_profile.get('mbti', '不明')}, あなたの性別: {user_profile.get('gender', '不明')}\n"
+        f"ユーザーの発言: {message}\n"
+        f"ユーザーは今つらい気持ちや悲しい気持ちを表現してるよ。\n"
+        f"アドバイスではなく、まずは共感と慰めを心がけてね。\n"
+        f"親しみやすく絶対にタメ口で絵文字も使って、短めに（150文字以内）返してね。\n"
+        f"具体的な解決策は求めず、気持ちに寄り添うことを最優先にしてね。\n"
+        f"絶対に敬語を使わず、タメ口で話してね！"
+    )
+
 def handle_emotional_support(user_id, message, user_profile):
     """感情的なサポート・慰め処理"""
     try:
@@ -3226,29 +4059,23 @@ def handle_emotional_support(user_id, message, user_profile):
             print("⚠️ OpenAI APIキーが設定されていません")
             return "つらかったね💕 あなたの気持ち、よくわかるよ✨"
         
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.8,            # 柔らかく多様な表現に
-            frequency_penalty=0.7,      # 同じ表現を避ける
-            presence_penalty=0.6,       # 新しい話題を促す
-            openai_api_key=openai_api_key
-        )
-        prompt = (
-            f"あなたはMBTI診断ベースの女性の恋愛マスターの友達だよ。\n"
-            f"ユーザー情報: あなたのMBTI: {user_profile.get('mbti', '不明')}, あなたの性別: {user_profile.get('gender', '不明')}\n"
-            f"ユーザーの発言: {message}\n"
-            f"ユーザーは今つらい気持ちや悲しい気持ちを表現してるよ。\n"
-            f"アドバイスではなく、まずは共感と慰めを心がけてね。\n"
-            f"親しみやすく絶対にタメ口で絵文字も使って、短めに（150文字以内）返してね。\n"
-            f"具体的な解決策は求めず、気持ちに寄り添うことを最優先にしてね。\n"
-            f"絶対に敬語を使わず、タメ口で話してね！"
-        )
+        prompt = build_emotional_support_prompt(message, user_profile)
         
-        response = llm.invoke(prompt)
-        return response.content
+        return invoke_llm("emotional_support", prompt)
     except Exception as e:
         return "つらかったね💕 あなたの気持ち、よくわかるよ✨"
 
+def build_casual_chat_prompt(message, user_profile):
+    """雑談用のプロンプトを作成"""
+    return (
+        f"あなたはMBTI診断ベースの女性の恋愛マスターの友達だよ。\n"
+        f"ユーザー情報: あなたのMBTI: {user_profile.get('mbti', '不明')}, あなたの性別: {user_profile.get('gender', '不明')}\n"
+        f"ユーザーの発言: {message}\n"
+        f"これは雑談だよ。親しみやすく絶対にタメ口で絵文字も使って、短めに（100文字以内）返してね。\n"
+        f"恋愛アドバイスではなく、日常会話として返してね。\n"
+        f"絶対に敬語を使わず、タメ口で話してね！"
+    )
+
 def handle_casual_chat(user_id, message, user_profile):
     """雑談処理"""
     try:
@@ -3256,27 +4083,49 @@ def handle_casual_chat(user_id, message, user_profile):
             print("⚠️ OpenAI APIキーが設定されていません")
             return "うん、そうだね！😊"
         
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.8,            # 柔らかく多様な表現に
-            frequency_penalty=0.7,      # 同じ表現を避ける
-            presence_penalty=0.6,       # 新しい話題を促す
-            openai_api_key=openai_api_key
-        )
-        prompt = (
-            f"あなたはMBTI診断ベースの女性の恋愛マスターの友達だよ。\n"
-            f"ユーザー情報: あなたのMBTI: {user_profile.get('mbti', '不明')}, あなたの性別: {user_profile.get('gender', '不明')}\n"
-            f"ユーザーの発言: {message}\n"
-            f"これは雑談だよ。親しみやすく絶対にタメ口で絵文字も使って、短めに（100文字以内）返してね。\n"
-            f"恋愛アドバイスではなく、日常会話として返してね。\n"
-            f"絶対に敬語を使わず、タメ口で話してね！"
-        )
+        prompt = build_casual_chat_prompt(message, user_profile)
         
-        response = llm.invoke(prompt)
-        return response.content
+        return invoke_llm("casual_chat", prompt)
     except Exception as e:
         return "うん、そうだね！😊"
 
+# 定型で返す意図（1: 挨拶, 2: 感謝, 3: 短い返事）
+CANNED_INTENT_REPLIES = {
+    1: "こんばんは！今日も気軽に話してね😊",
+    2: "どういたしまして！また何でも聞いてね✨",
+    3: "うん、また何かあったら教えてね！"
+}
+EMOTIONAL_SUPPORT_WORDS = ["つらい", "悲しい", "落ち込んでる", "辛い", "しんどい", "疲れた", "嫌だ", "もう嫌", "諦め", "無理"]
+
+def needs_emotional_support(message):
+    """慰めや共感が必要なメッセージかどうか"""
+    return any(word in message for word in EMOTIONAL_SUPPORT_WORDS)
+
+def question_type_label(question_type_num):
+    """質問タイプ番号（1-9）をラベルに変換"""
+    return QUESTION_TYPES[question_type_num - 1] if 1 <= question_type_num <= 9 else "一般的な相談"
+
+def answer_paid_chat(user_id, message, user_profile):
+    """有料会員のメッセージを分類し、意図に応じた返事を生成"""
+    # 意図と質問タイプを1回の呼び出しで分類（挨拶などはローカルで即判定、先読み済みならその結果）
+    prefetch = current_chat_prefetch(user_id, message)
+    intent, question_type_num = prefetch.classification() if prefetch else classify_message_fast(message)
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[process_ai_chat] intent classified as: {intent}, question_type: {question_type_num}\n")
+    
+    if intent in CANNED_INTENT_REPLIES:  # 挨拶・感謝・短い返事
+        return CANNED_INTENT_REPLIES[intent]
+    elif intent == 5:  # 雑談
+        return handle_casual_chat(user_id, message, user_profile)
+    else:  # 恋愛相談・その他（恋愛相談として処理）
+        # 慰めや共感が必要かどうかを判定
+        if needs_emotional_support(message):
+            return handle_emotional_support(user_id, message, user_profile)
+        
+        question_type = question_type_label(question_type_num)
+        
+        return ask_ai_with_vector_db(user_id, message, user_profile, question_type)
+
 # AIチャット処理関数
 def process_ai_chat(user_id, message, user_profile):
     os.makedirs("/data/logs", exist_ok=True)
@@ -3286,62 +4135,8 @@ def process_ai_chat(user_id, message, user_profile):
         if user_profile.get('is_paid', False):
             with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
                 f.write("[process_ai_chat] is_paid True, calling intent classification\n")
-            
-            # 意図分類
-            intent = classify_intent(message)
-            with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-                f.write(f"[process_ai_chat] intent classified as: {intent}\n")
-            
-            if intent == 1:  # 挨拶
-                return "こんばんは！今日も気軽に話してね😊"
-            elif intent == 2:  # 感謝
-                return "どういたしまして！また何でも聞いてね✨"
-            elif intent == 3:  # 短い返事
-                return "うん、また何かあったら教えてね！"
-            elif intent == 4:  # 恋愛相談
-                # 慰めや共感が必要かどうかを判定
-                if any(word in message for word in ["つらい", "悲しい", "落ち込んでる", "辛い", "しんどい", "疲れた", "嫌だ", "もう嫌", "諦め", "無理"]):
-                    return handle_emotional_support(user_id, message, user_profile)
-                
-                # 質問タイプを分類
-                question_type_num = classify_question_type(message)
-                question_types = [
-                    "方法論・アプローチ",
-                    "原因分析・理由説明", 
-                    "タイミング・時期",
-                    "場所・デートプラン",
-                    "具体的な内容・アイデア",
-                    "感情・心理",
-                    "LINE・メッセージ",
-                    "関係性・告白",
-                    "一般的な相談"
-                ]
-                question_type = question_types[question_type_num - 1] if 1 <= question_type_num <= 9 else "一般的な相談"
-                
-                return ask_ai_with_vector_db(user_id, message, user_profile, question_type)
-            elif intent == 5:  # 雑談
-                return handle_casual_chat(user_id, message, user_profile)
-            else:  # その他（恋愛相談として処理）
-                # 慰めや共感が必要かどうかを判定
-                if any(word in message for word in ["つらい", "悲しい", "落ち込んでる", "辛い", "しんどい", "疲れた", "嫌だ", "もう嫌", "諦め", "無理"]):
-                    return handle_emotional_support(user_id, message, user_profile)
-                
-                # 質問タイプを分類
-                question_type_num = classify_question_type(message)
-                question_types = [
-                    "方法論・アプローチ",
-                    "原因分析・理由説明", 
-                    "タイミング・時期",
-                    "場所・デートプラン",
-                    "具体的な内容・アイデア",
-                    "感情・心理",
-                    "LINE・メッセージ",
-                    "関係性・告白",
-                    "一般的な相談"
-                ]
-                question_type = question_types[question_type_num - 1] if 1 <= question_type_num <= 9 else "一般的な相談"
-                
-                return ask_ai_with_vector_db(user_id, message, user_profile, question_type)
+            # 締め切りを過ぎたら中継メッセージを返し、回答は後からプッシュする
+            return answer_within_deadline(user_profile, lambda: answer_paid_chat(user_id, message, user_profile))
         
         with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
             f.write("[process_ai_chat] is_paid False or not found\n")
@@ -3365,124 +4160,817 @@ def process_ai_chat(user_id, message, user_profile):
         traceback.print_exc()
         return "ごめんね、エラーが発生したよ😅 時間を置いて再度お試ししてね！"
 
-# LINE Webhookエンドポイント
-@app.route("/webhook", methods=["POST"])
-def line_webhook():
-    os.makedirs("/data/logs", exist_ok=True)
-    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-        f.write("[line_webhook] called\n")
-    try:
-        # LINEプラットフォームからのリクエストを受け取る
-        data = request.get_json()
-        print(f"LINE Webhook received: {data}")
-        
-        # LINE Webhookの検証（LINEプラットフォームからの検証リクエスト）
-        if 'events' not in data:
-            print("No events in data, returning 200")
-            return '', 200
-        
-        print(f"Processing {len(data['events'])} events")
-        
-        # イベントを処理
-        for event in data['events']:
-            print(f"Processing event: {event}")
-            
-            # テキストメッセージの処理
-            if event['type'] == 'message' and event['message']['type'] == 'text':
-                user_id = event['source']['userId']
-                user_message = event['message']['text'].strip()
-                reply_token = event['replyToken']
-                
-                print(f"User ID: {user_id}")
-                print(f"User message: {user_message}")
-                
-                # ユーザープロファイルを取得
-                user_profile = get_user_profile(user_id)
-                print(f"User profile: {user_profile}")
-                
-                # メッセージを処理
-                response_message = process_user_message(user_id, user_message, user_profile)
-                print(f"Response message: {response_message}")
-                
-                # LINEにリプライを送信
-                send_line_reply(reply_token, response_message)
-            
-            # ボタンクリック（postback）の処理
-            elif event['type'] == 'postback':
-                user_id = event['source']['userId']
-                postback_data = event['postback']['data']
-                reply_token = event['replyToken']
-                
-                print(f"Postback from user_id: {user_id}")
-                print(f"Postback data: {postback_data}")
-                
-                # MBTI回答の処理
-                if postback_data.startswith('mbti_answer:'):
-                    parts = postback_data.split(':')
-                    if len(parts) == 3:
-                        answer = "はい" if parts[1] == "yes" else "いいえ"
-                        question_index = int(parts[2])
-                        
-                        # ユーザープロファイルを取得
-                        user_profile = get_user_profile(user_id)
-                        
-                        # Bot側の吹き出しで「あなたの回答：はい/いいえ」を表示
-                        bot_answer_message = f"あなたの回答：{answer}"
-                        send_line_reply(reply_token, bot_answer_message)
-                        
-                        # 少し遅延させてから次の質問を処理（スピードアップ）
-                        import threading
-                        import time
-                        
-                        def process_next_question():
-                            time.sleep(0.5)  # 0.5秒に短縮
-                            # MBTI回答を処理
-                            response_message = process_mbti_answer(user_id, answer, user_profile)
-                            print(f"MBTI response: {response_message}")
-                            
-                            # 次の質問または診断完了を送信
-                            line_token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-                            if line_token:
-                                url = "https://api.line.me/v2/bot/message/push"
-                                headers = {
-                                    "Content-Type": "application/json",
-                                    "Authorization": f"Bearer {line_token}"
-                                }
-                                
-                                # メッセージが辞書（テンプレート）の場合はそのまま使用
-                                if isinstance(response_message, dict):
-                                    data = {
-                                        "to": user_id,
-                                        "messages": [response_message]
-                                    }
-                                else:
-                                    # 文字列の場合は通常のテキストメッセージ
-                                    data = {
-                                        "to": user_id,
-                                        "messages": [{"type": "text", "text": response_message}]
-                                    }
-                                
-                                response = requests.post(url, headers=headers, json=data)
-                                print(f"Next question sent: {response.status_code}")
-                                
-                                # 診断完了の場合、課金誘導メッセージを別途送信
-                                if "診断完了" in str(response_message):
-                                    time.sleep(1)  # 1秒に短縮
-                                    payment_message = get_payment_message(user_id)
-                                    send_line_reply(reply_token, payment_message)
-                        
-                        threading.Thread(target=process_next_question).start()
-        
-        return '', 200
-        
-    except Exception as e:
-        print(f"LINE Webhook error: {e}")
-        return '', 200
+# 🚀 AIチャットの先読み（プロフィール・履歴・分類を並行して開始し、使わなかった分は捨てる）
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "8"))
+PAID_USER_HINT_MAX_ENTRIES = int(os.getenv("PAID_USER_HINT_MAX_ENTRIES", "10000"))
+# AIチャットに回らない定型コマンド（分類を先読みしても無駄になる）
+CHAT_COMMAND_WORDS = ["解約", "キャンセル", "やめる", "退会", "診断開始", "性別登録", "相手MBTI登録"]
+# 返答待ちの登録・診断モード（この間のメッセージもAIチャットに回らない）
+CHAT_BLOCKING_MODES = ('mbti_diagnosis', 'register_gender', 'register_partner_mbti')
 
-# 課金完了Webhookエンドポイント
-@app.route("/payment_webhook", methods=["POST"])
-def payment_webhook():
-    """課金完了時のWebhook"""
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+# 最近有料会員だったユーザー（分類を投機的に始めてよいかの目安。外れたら結果を捨てるだけ）
+_paid_user_hint = OrderedDict()
+_paid_user_hint_lock = threading.Lock()
+_prefetch_stats = {"speculative": 0, "used": 0, "discarded": 0}
+
+def remember_paid_user(user_id, user_profile):
+    with _paid_user_hint_lock:
+        if user_profile.get('is_paid', False) and user_profile.get('mode') not in CHAT_BLOCKING_MODES:
+            _paid_user_hint[user_id] = True
+            _paid_user_hint.move_to_end(user_id)
+            while len(_paid_user_hint) > PAID_USER_HINT_MAX_ENTRIES:
+                _paid_user_hint.popitem(last=False)
+        else:
+            _paid_user_hint.pop(user_id, None)
+
+def should_speculate_classification(user_id, message):
+    """プロフィールを読む前に分類を始めてよいか（最近の有料会員で、コマンドでない）"""
+    if not PREFETCH_ENABLED or message in CHAT_COMMAND_WORDS:
+        return False
+    with _paid_user_hint_lock:
+        return user_id in _paid_user_hint
+
+def _count_prefetch(key):
+    with _paid_user_hint_lock:
+        _prefetch_stats[key] += 1
+
+class ChatPrefetch:
+    """1件のメッセージに必要な読み込みをまとめて並行に始め、必要になった時点で結果を受け取る"""
+
+    def __init__(self, user_id, message):
+        self.user_id = user_id
+        self.message = message
+        self._profile = _prefetch_executor.submit(get_user_profile, user_id)
+        self._history = _prefetch_executor.submit(get_recent_history, user_id) if PREFETCH_ENABLED else None
+        self._classification = None
+        if should_speculate_classification(user_id, message):
+            _count_prefetch("speculative")
+            self._classification = _prefetch_executor.submit(classify_message_fast, message)
+        self._classification_counted = False
+        self._discarded = False
+
+    def matches(self, user_id, message):
+        return self.user_id == user_id and self.message == message
+
+    def profile(self):
+        user_profile = self._profile.result()
+        remember_paid_user(self.user_id, user_profile)
+        return user_profile
+
+    @staticmethod
+    def _result(future, fallback, *args):
+        """先読みの結果を受け取る（先読みしていない・取り消し済みならその場で読み込む）"""
+        if future is not None:
+            try:
+                return future.result()
+            except FutureCancelledError:
+                pass
+        return fallback(*args)
+
+    def _count_classification(self, key):
+        # 先読みした分類は「使った」「捨てた」のどちらか一度だけ数える
+        if self._classification is not None and not self._classification_counted:
+            self._classification_counted = True
+            _count_prefetch(key)
+
+    def history(self):
+        return self._result(self._history, get_recent_history, self.user_id)
+
+    def classification(self):
+        self._count_classification("used")
+        return self._result(self._classification, classify_message_fast, self.message)
+
+    def discard(self):
+        """使われなかった先読みを取り消す（実行中のものは結果を捨てる）"""
+        if self._discarded:
+            return
+        self._discarded = True
+        for future in (self._history, self._classification):
+            if future is not None:
+                future.cancel()
+        self._count_classification("discarded")
+
+def current_chat_prefetch(user_id, message):
+    """処理中のイベントの先読み（同じユーザー・同じメッセージのものだけ）を取得"""
+    prefetch = getattr(_event_context, "prefetch", None)
+    if prefetch is not None and prefetch.matches(user_id, message):
+        return prefetch
+    return None
+
+def get_prefetch_stats():
+    with _paid_user_hint_lock:
+        return {
+            "enabled": PREFETCH_ENABLED,
+            "paid_user_hints": len(_paid_user_hint),
+            **_prefetch_stats
+        }
+
+# ⏰ 応答の締め切り（超えたら中継メッセージを先に返し、回答は後からプッシュ）
+RESPONSE_SLO_SECONDS = float(os.getenv("RESPONSE_SLO_SECONDS", "8"))
+# 締め切りを見張るスレッド数（同時に処理するイベント数と同じだけあれば待たされない）
+SLO_WORKERS = int(os.getenv("SLO_WORKERS", "32"))
+SLO_INTERIM_SUFFIX = "\n回答をまとめてるから、少しだけ待っててね⏳"
+
+_slo_executor = ThreadPoolExecutor(max_workers=SLO_WORKERS, thread_name_prefix="slo")
+_slo_stats_lock = threading.Lock()
+_slo_stats = {"guarded": 0, "fired": 0, "late_completed": 0, "late_failed": 0}
+
+def _count_slo(key):
+    with _slo_stats_lock:
+        _slo_stats[key] += 1
+
+def event_deadline(received_at=None):
+    """Webhookを受け取った時刻（time.time基準）から数えた締め切りを time.monotonic 基準で返す"""
+    elapsed = max(0.0, time.time() - received_at) if received_at else 0.0
+    return time.monotonic() + RESPONSE_SLO_SECONDS - elapsed
+
+def current_deadline():
+    """処理中のイベントの締め切り（time.monotonic基準、締め切りなしならNone）"""
+    return getattr(_event_context, "deadline", None)
+
+def build_interim_message(user_profile):
+    """締め切りに間に合わないときに先に返す中継メッセージ"""
+    return get_random_response_pattern("advice_intro", user_profile) + SLO_INTERIM_SUFFIX
+
+def answer_within_deadline(user_profile, generate):
+    """generate()をこのスレッドで実行し、締め切りまでに終わらなければ中継メッセージを先にリプライする
+    回答は生成後に呼び出し元から（リプライ済みならプッシュで）届ける。生成が終わるまでこのユーザーの次のイベントは待たせる"""
+    deadline = current_deadline()
+    batch = current_outbound_batch()
+    if deadline is None or batch is None:
+        return generate()
+    finished = threading.Event()
+    state = {"fired": False}
+
+    def watch():
+        if finished.wait(max(0.0, deadline - time.monotonic())):
+            return
+        # 回答の送信より先に中継メッセージが届くよう、送信ロックを握ったまま確認する
+        with batch.lock:
+            if finished.is_set():
+                return
+            state["fired"] = True
+            # ストリーミングで最初の吹き出しがもう届いていれば中継メッセージは不要
+            batch.send_if_unreplied(build_interim_message(user_profile))
+        _count_slo("fired")
+        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+            f.write(f"[answer_within_deadline] deadline exceeded, user_id={batch.user_id}\n")
+
+    _count_slo("guarded")
+    _slo_executor.submit(watch)
+    failed = True
+    try:
+        result = generate()
+        failed = False
+        return result
+    finally:
+        with batch.lock:
+            finished.set()
+            fired = state["fired"]
+        if fired:
+            _count_slo("late_failed" if failed else "late_completed")
+
+def get_slo_stats():
+    with _slo_stats_lock:
+        return {"slo_seconds": RESPONSE_SLO_SECONDS, **_slo_stats}
+
+# ⚡ asyncio版のAIチャット処理（待ち時間の長いOpenAI呼び出しを1本のイベントループで多重化）
+ASYNC_PIPELINE_ENABLED = os.getenv("ASYNC_PIPELINE_ENABLED", "0") == "1"
+# OpenAIへの同時リクエスト数の上限（プロセス全体で共有）
+OPENAI_MAX_INFLIGHT = int(os.getenv("OPENAI_MAX_INFLIGHT", "50"))
+# イベントループ上で同時に進める会話数の上限（超えたらディスパッチャ側で待つ）
+ASYNC_MAX_CONVERSATIONS = int(os.getenv("ASYNC_MAX_CONVERSATIONS", "500"))
+
+_async_loop = None
+_async_loop_lock = threading.Lock()
+_openai_semaphore = None
+_conversation_slots = threading.BoundedSemaphore(ASYNC_MAX_CONVERSATIONS)
+# ユーザーごとのロック {ユーザーID: [asyncio.Lock, 待ち数]}（イベントループのスレッドからのみ触る）
+_user_locks = {}
+_async_stats = {"conversations": 0, "openai_inflight": 0, "completed": 0, "failed": 0}
+
+def get_async_loop():
+    """AIチャット用のイベントループを取得（初回だけ専用スレッドで起動）"""
+    global _async_loop, _openai_semaphore
+    with _async_loop_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-pipeline", daemon=True).start()
+            _openai_semaphore = asyncio.Semaphore(OPENAI_MAX_INFLIGHT)
+            _async_loop = loop
+            print(f"✅ asyncioパイプラインを起動しました（OpenAI同時実行: {OPENAI_MAX_INFLIGHT}, 会話上限: {ASYNC_MAX_CONVERSATIONS}）")
+        return _async_loop
+
+@asynccontextmanager
+async def user_turn(key):
+    """同じユーザーのイベントを到着順に1件ずつ処理する"""
+    entry = _user_locks.get(key)
+    if entry is None:
+        entry = _user_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[key]
+
+async def ainvoke_llm(route, prompt, prompt_tokens=None):
+    """同時実行数の上限を守りながら、ルートのモデルを非同期で呼び出す"""
+    async with _openai_semaphore:
+        _async_stats["openai_inflight"] += 1
+        started = time.monotonic()
+        try:
+            content = (await get_llm(route).ainvoke(prompt)).content
+        except Exception:
+            record_llm_call(route, started, prompt, prompt_tokens=prompt_tokens)
+            raise
+        finally:
+            _async_stats["openai_inflight"] -= 1
+    record_llm_call(route, started, prompt, content, prompt_tokens)
+    return content
+
+async def astream_answer_to_batch(route, prompt, batch, prompt_tokens=None):
+    """stream_answer_to_batchの非同期版"""
+    started = time.monotonic()
+    splitter = BubbleSplitter()
+    bubbles = []
+
+    async def send(bubble):
+        if not bubbles:
+            with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+                f.write(f"[astream_answer_to_batch] first bubble after {time.monotonic() - started:.2f}s\n")
+        bubbles.append(bubble)
+        await asyncio.to_thread(batch.stream, bubble)
+
+    async with _openai_semaphore:
+        _async_stats["openai_inflight"] += 1
+        try:
+            async for chunk in get_llm(route).astream(prompt):
+                bubble = splitter.feed(chunk.content)
+                if bubble:
+                    await send(bubble)
+        except Exception:
+            record_llm_call(route, started, prompt, prompt_tokens=prompt_tokens)
+            raise
+        finally:
+            _async_stats["openai_inflight"] -= 1
+    bubble = splitter.finish()
+    if bubble:
+        await send(bubble)
+    record_llm_call(route, started, prompt, "".join(bubbles), prompt_tokens)
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[astream_answer_to_batch] {len(bubbles)} bubbles in {time.monotonic() - started:.2f}s\n")
+    return "\n".join(bubbles), bool(bubbles)
+
+async def classify_message_async(message):
+    """classify_message_fastの非同期版"""
+    intent = await asyncio.to_thread(try_fast_path_classification, message)
+    if intent is not None:
+        return intent, 9
+    try:
+        cached = await asyncio.to_thread(classification_memo.get, "message", message)
+        if cached is not None:
+            return tuple(cached)
+        
+        if not openai_api_key or openai_api_key == "dummy_key_for_development":
+            print("⚠️ OpenAI APIキーが設定されていません")
+            return 9, 9  # デフォルトは「その他」「一般的な相談」
+        
+        content = await ainvoke_llm("classify", f"{CLASSIFY_MESSAGE_PROMPT}\n\nMessage: {message}")
+        return await asyncio.to_thread(record_classification, message, content)
+    except Exception as e:
+        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+            f.write(f"[classify_message] error: {e}\n")
+        return 9, 9  # デフォルトは「その他」「一般的な相談」
+
+async def chat_reply_async(route, prompt, fallback):
+    """雑談・慰め用の短い返事を非同期で生成（失敗したら定型文）"""
+    if not openai_api_key or openai_api_key == "dummy_key_for_development":
+        print("⚠️ OpenAI APIキーが設定されていません")
+        return fallback
+    try:
+        return await ainvoke_llm(route, prompt)
+    except Exception as e:
+        return fallback
+
+async def ask_ai_with_vector_db_async(user_id, question, user_profile, question_type="一般的な相談", batch=None, history_task=None):
+    """ask_ai_with_vector_dbの非同期版（DBアクセスはスレッドに逃がす）"""
+    history = await history_task if history_task is not None else None
+    early_answer, advice = await asyncio.to_thread(prepare_advice_request, user_id, question, user_profile, question_type, history)
+    if advice is None:
+        return early_answer
+    try:
+        if STREAMING_ENABLED and batch is not None and batch.user_id == user_id:
+            answer, delivered = await astream_answer_to_batch("advice", advice["prompt"], batch, advice["prompt_tokens"])
+        else:
+            answer, delivered = await ainvoke_llm("advice", advice["prompt"], advice["prompt_tokens"]), False
+        answer = await asyncio.to_thread(finish_advice_request, user_id, question, user_profile, question_type, advice, answer)
+        # 吹き出しで送信済みなら、呼び出し元から送るものはない
+        return None if delivered else answer
+    except Exception as e:
+        log_advice_error(e)
+        return "AI応答中にエラーが発生しました。"
+
+async def process_ai_chat_async(user_id, message, user_profile, batch=None, prefetched=None):
+    """有料会員のAIチャットを非同期で処理（process_ai_chatと同じ分岐）
+    prefetchedには先読み中のタスク {"history": ..., "classification": ...} を渡せる"""
+    prefetched = prefetched or {}
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[process_ai_chat_async] user_id={user_id}, message={message}, user_profile={user_profile}\n")
+    try:
+        if prefetched.get("classification") is not None:
+            intent, question_type_num = await prefetched["classification"]
+        else:
+            intent, question_type_num = await classify_message_async(message)
+        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+            f.write(f"[process_ai_chat_async] intent classified as: {intent}, question_type: {question_type_num}\n")
+        
+        if intent in CANNED_INTENT_REPLIES:
+            return CANNED_INTENT_REPLIES[intent]
+        elif intent == 5:
+            return await chat_reply_async("casual_chat", build_casual_chat_prompt(message, user_profile), "うん、そうだね！😊")
+        if needs_emotional_support(message):
+            return await chat_reply_async("emotional_support", build_emotional_support_prompt(message, user_profile), "つらかったね💕 あなたの気持ち、よくわかるよ✨")
+        return await ask_ai_with_vector_db_async(
+            user_id, message, user_profile, question_type_label(question_type_num), batch, prefetched.get("history")
+        )
+    except Exception as e:
+        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+            f.write(f"[process_ai_chat_async] Exception: {e}\n")
+            f.write(traceback.format_exc() + "\n")
+        traceback.print_exc()
+        return "ごめんね、エラーが発生したよ😅 時間を置いて再度お試ししてね！"
+
+def is_ai_chat_message(message, user_profile):
+    """process_user_messageでAIチャットに回るメッセージかどうか"""
+    if user_profile.get('mode') in CHAT_BLOCKING_MODES or message in CHAT_COMMAND_WORDS:
+        return False
+    return user_profile.get('is_paid', False)
+
+async def handle_line_event_async(event, received_at=None):
+    """handle_line_eventの非同期版（AIチャット以外は同期版をスレッドで実行）"""
+    async with user_turn(line_event_partition_key(event)):
+        if event['type'] == 'message' and event['message']['type'] == 'text':
+            user_id = event['source']['userId']
+            user_message = event['message']['text'].strip()
+            deadline = event_deadline(received_at)
+            # プロフィール・履歴（有料会員なら分類も）を並行して読み込む
+            prefetched = {}
+            if PREFETCH_ENABLED:
+                prefetched["history"] = asyncio.create_task(asyncio.to_thread(get_recent_history, user_id))
+            if should_speculate_classification(user_id, user_message):
+                _count_prefetch("speculative")
+                prefetched["classification"] = asyncio.create_task(classify_message_async(user_message))
+            ai_chat = False
+            try:
+                user_profile = await asyncio.to_thread(get_user_profile, user_id)
+                remember_paid_user(user_id, user_profile)
+                ai_chat = is_ai_chat_message(user_message, user_profile)
+                if ai_chat:
+                    batch = OutboundBatch(event['replyToken'], user_id)
+                    chat = asyncio.create_task(process_ai_chat_async(user_id, user_message, user_profile, batch, prefetched))
+                    _count_slo("guarded")
+                    done, _ = await asyncio.wait({chat}, timeout=max(0.0, deadline - time.monotonic()))
+                    if not done:
+                        # 締め切りを過ぎたら中継メッセージを先にリプライし、回答は後からプッシュする
+                        _count_slo("fired")
+                        await asyncio.to_thread(batch.send_if_unreplied, build_interim_message(user_profile))
+                    response_message = await chat
+                    print(f"Response message: {response_message}")
+                    batch.add(response_message)
+                    await asyncio.to_thread(batch.flush)
+                    if not done:
+                        _count_slo("late_completed")
+                    return
+            finally:
+                # 使わなかった先読みは取り消す
+                for task in prefetched.values():
+                    if not task.done():
+                        task.cancel()
+                if "classification" in prefetched:
+                    _count_prefetch("used" if ai_chat else "discarded")
+        await asyncio.to_thread(handle_line_event, event, received_at)
+
+async def _run_queued_event_async(queue_id, event, received_at=None):
+    _async_stats["conversations"] += 1
+    try:
+        await handle_line_event_async(event, received_at)
+        await asyncio.to_thread(complete_webhook_event, queue_id)
+        _async_stats["completed"] += 1
+    except Exception as e:
+        print(f"❌ Webhookイベント処理エラー: queue_id={queue_id}, error={e}")
+        traceback.print_exc()
+        _async_stats["failed"] += 1
+        await asyncio.to_thread(fail_webhook_event, queue_id)
+    finally:
+        _async_stats["conversations"] -= 1
+        _conversation_slots.release()
+
+def submit_async_event(queue_id, event, received_at=None):
+    """キューのイベントをイベントループに渡す（会話数が上限なら空くまで待つ）"""
+    loop = get_async_loop()
+    _conversation_slots.acquire()
+    try:
+        asyncio.run_coroutine_threadsafe(_run_queued_event_async(queue_id, event, received_at), loop)
+    except Exception:
+        _conversation_slots.release()
+        raise
+
+def get_async_pipeline_stats():
+    return {
+        "enabled": ASYNC_PIPELINE_ENABLED,
+        "active_users": len(_user_locks),
+        **_async_stats
+    }
+
+# 📥 LINE Webhookイベントキュー（SQLite永続化）
+WEBHOOK_WORKER_COUNT = int(os.getenv("WEBHOOK_WORKER_COUNT", "4"))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", str(WEBHOOK_WORKER_COUNT * 8)))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "3"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "1.0"))
+WEBHOOK_CLAIM_TIMEOUT = float(os.getenv("WEBHOOK_CLAIM_TIMEOUT", "300"))
+
+_webhook_queue_wakeup = threading.Event()
+_webhook_pump = None
+_webhook_pump_lock = threading.Lock()
+WEBHOOK_PROCESS_TAG = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def line_event_partition_key(event):
+    """イベントの順序を保証する単位（ユーザー）を返す"""
+    source = event.get('source', {})
+    return source.get('userId') or source.get('groupId') or source.get('roomId') or "_no_source"
+
+# 🔁 再送イベントの重複排除（メモリ + SQLite）
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", str(24 * 60 * 60)))
+WEBHOOK_DEDUP_MEMORY_SIZE = int(os.getenv("WEBHOOK_DEDUP_MEMORY_SIZE", "10000"))
+
+_dedup_seen = OrderedDict()
+_dedup_lock = threading.Lock()
+_dedup_last_purge = 0.0
+_dedup_stats = {"checked": 0, "duplicates": 0, "memory_hits": 0, "db_hits": 0}
+
+def _remember_event_id(event_id, now):
+    """メモリ上の重複排除インデックスに記録（古いものから追い出す）"""
+    _dedup_seen[event_id] = now + WEBHOOK_DEDUP_TTL
+    _dedup_seen.move_to_end(event_id)
+    while len(_dedup_seen) > WEBHOOK_DEDUP_MEMORY_SIZE:
+        _dedup_seen.popitem(last=False)
+
+def filter_duplicate_events(events):
+    """メモリ上で処理済みとわかっているwebhookEventIdのイベントを取り除く（残すイベントの順序はそのまま）
+    メモリにないIDは enqueue_webhook_events がキューへの書き込みと同じトランザクションでSQLiteと照合する"""
+    now = time.time()
+    kept = []
+    with _dedup_lock:
+        for event in events:
+            event_id = event.get('webhookEventId')
+            _dedup_stats["checked"] += 1
+            expires_at = _dedup_seen.get(event_id) if event_id else None
+            if expires_at and expires_at > now:
+                _dedup_stats["duplicates"] += 1
+                _dedup_stats["memory_hits"] += 1
+                print(f"🔁 重複イベントをスキップ: {event_id} (redelivery={event.get('deliveryContext', {}).get('isRedelivery')})")
+                continue
+            kept.append(event)
+    return kept
+
+def remember_webhook_events(events, now=None):
+    """キューに積んだ（または直接処理に回した）イベントのIDをメモリに記録"""
+    now = now or time.time()
+    with _dedup_lock:
+        for event in events:
+            if event.get('webhookEventId'):
+                _remember_event_id(event['webhookEventId'], now)
+
+def _record_webhook_event_ids(cursor, events, now):
+    """処理済みIDをSQLiteに記録し、既に記録済み（重複）のイベントを id(event) の集合で返す
+    同じバッチ内の同一IDは最初の1件だけ残す。コミットは呼び出し元のトランザクションで行う"""
+    global _dedup_last_purge
+    if now - _dedup_last_purge > 60:
+        cursor.execute("DELETE FROM processed_webhook_events WHERE seen_at < ?", (now - WEBHOOK_DEDUP_TTL,))
+        _dedup_last_purge = now
+    duplicates = set()
+    for event in events:
+        if not event.get('webhookEventId'):
+            continue
+        cursor.execute(
+            """INSERT INTO processed_webhook_events (event_id, seen_at) VALUES (?, ?)
+               ON CONFLICT(event_id) DO UPDATE SET seen_at=excluded.seen_at
+               WHERE processed_webhook_events.seen_at < ?""",
+            (event['webhookEventId'], now, now - WEBHOOK_DEDUP_TTL)
+        )
+        if cursor.rowcount == 0:
+            with _dedup_lock:
+                _dedup_stats["duplicates"] += 1
+                _dedup_stats["db_hits"] += 1
+            print(f"🔁 重複イベントをスキップ(DB): {event['webhookEventId']}")
+            duplicates.add(id(event))
+    return duplicates
+
+def get_dedup_stats():
+    """重複排除の統計を取得"""
+    with _dedup_lock:
+        return dict(_dedup_stats, memory_size=len(_dedup_seen))
+
+def enqueue_webhook_events(events):
+    """Webhookイベントを永続キューに書き込み、書き込んだ件数を返す
+    処理済みIDの記録とキューへの書き込みは同じトランザクション（途中で落ちてもLINEの再送で取りこぼさない）"""
+    now = time.time()
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        cursor = conn.cursor()
+        duplicates = _record_webhook_event_ids(cursor, events, now)
+        fresh = [event for event in events if id(event) not in duplicates]
+        cursor.executemany(
+            "INSERT INTO webhook_queue (user_id, event, status, created_at, updated_at) VALUES (?, ?, 'pending', ?, ?)",
+            [(line_event_partition_key(event), json.dumps(event, ensure_ascii=False), now, now) for event in fresh]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    remember_webhook_events(events, now)
+    if fresh:
+        _webhook_queue_wakeup.set()
+    return len(fresh)
+
+def claim_webhook_events(claimed_by, limit=1):
+    """未処理のイベントを古い順に取得し、処理中としてマークする"""
+    now = time.time()
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        # 処理中のまま落ちた別プロセスのイベントを未処理に戻す
+        cursor.execute(
+            "UPDATE webhook_queue SET status='pending', claimed_by=NULL WHERE status='processing' AND claimed_by != ? AND updated_at < ?",
+            (claimed_by, now - WEBHOOK_CLAIM_TIMEOUT)
+        )
+        # 別プロセスが処理中のユーザーのイベントは取らない（ユーザー内の順序を守る）
+        cursor.execute(
+            """SELECT id, event, created_at FROM webhook_queue
+               WHERE status='pending'
+                 AND user_id NOT IN (
+                     SELECT user_id FROM webhook_queue WHERE status='processing' AND claimed_by != ?
+                 )
+               ORDER BY id LIMIT ?""",
+            (claimed_by, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.executemany(
+            "UPDATE webhook_queue SET status='processing', claimed_by=?, attempts=attempts+1, updated_at=? WHERE id=?",
+            [(claimed_by, now, row[0]) for row in rows]
+        )
+        cursor.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return [(row[0], json.loads(row[1]), row[2]) for row in rows]
+
+def complete_webhook_event(queue_id):
+    """処理が完了したイベントをキューから削除"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM webhook_queue WHERE id=?", (queue_id,))
+    conn.commit()
+    conn.close()
+
+def fail_webhook_event(queue_id):
+    """失敗したイベントを再試行待ちに戻す（上限を超えたらfailedにする）"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE webhook_queue SET status=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, claimed_by=NULL, updated_at=? WHERE id=?",
+        (WEBHOOK_MAX_ATTEMPTS, time.time(), queue_id)
+    )
+    conn.commit()
+    conn.close()
+
+# 🔀 ユーザー単位で順序を守りつつ、ユーザー間は並列に処理するディスパッチャ
+class UserOrderedDispatcher:
+    """同じキーのタスクは投入順に1つずつ、別のキーのタスクは固定サイズのスレッドプールで並列実行する"""
+
+    def __init__(self, max_workers, max_inflight, name="dispatcher"):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._max_inflight = max_inflight
+        self._inflight = 0
+        self._lanes = {}
+        self._cond = threading.Condition()
+
+    def free_slots(self):
+        with self._cond:
+            return self._max_inflight - self._inflight
+
+    def wait_for_slot(self, timeout):
+        """空きができるまで待つ（空きがあればTrue）"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._inflight < self._max_inflight, timeout)
+
+    def submit(self, key, fn, *args):
+        with self._cond:
+            self._inflight += 1
+            lane = self._lanes.get(key)
+            if lane is not None:
+                # このユーザーの処理中タスクが終わった後に実行される
+                lane.append((fn, args))
+                return
+            self._lanes[key] = deque([(fn, args)])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._cond:
+                lane = self._lanes[key]
+                if not lane:
+                    del self._lanes[key]
+                    return
+                fn, args = lane[0]
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"❌ ディスパッチャタスクエラー: key={key}, error={e}")
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    lane.popleft()
+                    self._inflight -= 1
+                    self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "inflight": self._inflight,
+                "active_users": len(self._lanes),
+                "max_inflight": self._max_inflight
+            }
+
+_event_dispatcher = UserOrderedDispatcher(WEBHOOK_WORKER_COUNT, WEBHOOK_MAX_INFLIGHT, name="line-event")
+
+def _run_queued_event(queue_id, event, received_at=None):
+    """キューから取り出したイベントを処理し、結果をキューに反映"""
+    if ASYNC_PIPELINE_ENABLED:
+        try:
+            submit_async_event(queue_id, event, received_at)
+        except Exception as e:
+            print(f"❌ Webhookイベント投入エラー: queue_id={queue_id}, error={e}")
+            fail_webhook_event(queue_id)
+        return
+    try:
+        handle_line_event(event, received_at)
+        complete_webhook_event(queue_id)
+    except Exception as e:
+        print(f"❌ Webhookイベント処理エラー: queue_id={queue_id}, error={e}")
+        traceback.print_exc()
+        fail_webhook_event(queue_id)
+
+def _webhook_pump_loop():
+    """キューからイベントを取り出し、ユーザーごとにディスパッチャへ振り分ける"""
+    while True:
+        if not _event_dispatcher.wait_for_slot(WEBHOOK_POLL_INTERVAL):
+            continue
+        try:
+            claimed = claim_webhook_events(WEBHOOK_PROCESS_TAG, limit=_event_dispatcher.free_slots())
+        except Exception as e:
+            print(f"❌ Webhookキュー取得エラー: {e}")
+            time.sleep(WEBHOOK_POLL_INTERVAL)
+            continue
+        if not claimed:
+            _webhook_queue_wakeup.wait(WEBHOOK_POLL_INTERVAL)
+            _webhook_queue_wakeup.clear()
+            continue
+        for queue_id, event, received_at in claimed:
+            _event_dispatcher.submit(line_event_partition_key(event), _run_queued_event, queue_id, event, received_at)
+
+def start_webhook_workers():
+    """Webhookキューの取り出しスレッドを起動（複数回呼んでも1回だけ起動）"""
+    global _webhook_pump
+    with _webhook_pump_lock:
+        if _webhook_pump is not None:
+            return
+        _webhook_pump = threading.Thread(target=_webhook_pump_loop, name="webhook-pump", daemon=True)
+        _webhook_pump.start()
+        print(f"✅ Webhookワーカーを起動しました（並列数: {WEBHOOK_WORKER_COUNT}, 同時処理上限: {WEBHOOK_MAX_INFLIGHT}）")
+
+# LINEイベント1件の処理
+def handle_line_event(event, received_at=None):
+    """LINE Webhookイベントを1件処理（received_atはWebhookを受け取った時刻。応答の締め切りの起点）"""
+    print(f"Processing event: {event}")
+
+    # テキストメッセージの処理
+    if event['type'] == 'message' and event['message']['type'] == 'text':
+        user_id = event['source']['userId']
+        user_message = event['message']['text'].strip()
+        reply_token = event['replyToken']
+
+        print(f"User ID: {user_id}")
+        print(f"User message: {user_message}")
+
+        # プロフィール・履歴（有料会員なら分類も）の読み込みを並行して始める
+        deadline = event_deadline(received_at)
+        prefetch = ChatPrefetch(user_id, user_message)
+        user_profile = prefetch.profile()
+        print(f"User profile: {user_profile}")
+
+        # メッセージを処理
+        batch = OutboundBatch(reply_token, user_id)
+        _event_context.batch = batch
+        _event_context.prefetch = prefetch
+        _event_context.deadline = deadline
+        try:
+            response_message = process_user_message(user_id, user_message, user_profile)
+        finally:
+            _event_context.batch = None
+            _event_context.prefetch = None
+            _event_context.deadline = None
+            prefetch.discard()
+        print(f"Response message: {response_message}")
+
+        # LINEにリプライを送信
+        batch.add(response_message)
+        batch.flush()
+
+    # ボタンクリック（postback）の処理
+    elif event['type'] == 'postback':
+        user_id = event['source']['userId']
+        postback_data = event['postback']['data']
+        reply_token = event['replyToken']
+
+        print(f"Postback from user_id: {user_id}")
+        print(f"Postback data: {postback_data}")
+
+        # MBTI回答の処理
+        if postback_data.startswith('mbti_answer:'):
+            parts = postback_data.split(':')
+            if len(parts) == 3:
+                answer = "はい" if parts[1] == "yes" else "いいえ"
+                question_index = int(parts[2])
+
+                # ユーザープロファイルを取得
+                user_profile = get_user_profile(user_id)
+
+                # Bot側の吹き出しで「あなたの回答：はい/いいえ」を表示
+                batch = OutboundBatch(reply_token, user_id)
+                batch.add(f"あなたの回答：{answer}")
+
+                # MBTI回答を処理し、次の質問（診断完了時は結果と課金誘導）を同じリプライで送る
+                _event_context.batch = batch
+                try:
+                    response_message = process_mbti_answer(user_id, answer, user_profile)
+                finally:
+                    _event_context.batch = None
+                print(f"MBTI response: {response_message}")
+                batch.add(response_message)
+                batch.flush()
+
+# LINE Webhookエンドポイント
+@app.route("/webhook", methods=["POST"])
+def line_webhook():
+    os.makedirs("/data/logs", exist_ok=True)
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write("[line_webhook] called\n")
+    try:
+        # LINEプラットフォームからのリクエストを受け取る
+        data = request.get_json()
+        print(f"LINE Webhook received: {data}")
+        
+        # LINE Webhookの検証（LINEプラットフォームからの検証リクエスト）
+        if 'events' not in data:
+            print("No events in data, returning 200")
+            return '', 200
+        
+        # LINEの再送で届いた処理済みイベントは何もせずに捨てる（SQLiteでの確認はキューへの書き込み時）
+        events = filter_duplicate_events(data['events'])
+        if not events:
+            return '', 200
+        
+        # イベントはキューに積むだけにして即座に200を返す（処理はワーカーが行う）
+        try:
+            queued = enqueue_webhook_events(events)
+            print(f"Queued {queued} events")
+        except Exception as e:
+            # キューに書けない場合はディスパッチャに直接渡してイベントを取りこぼさない
+            print(f"❌ Webhookキュー書き込みエラー: {e}")
+            received_at = time.time()
+            remember_webhook_events(events, received_at)
+            for event in events:
+                _event_dispatcher.submit(line_event_partition_key(event), handle_line_event, event, received_at)
+        
+        return '', 200
+        
+    except Exception as e:
+        print(f"LINE Webhook error: {e}")
+        return '', 200
+
+# 課金完了Webhookエンドポイント
+@app.route("/payment_webhook", methods=["POST"])
+def payment_webhook():
+    """課金完了時のWebhook"""
     try:
         data = request.get_json()
         user_id = data.get('userId')
@@ -3512,6 +5000,27 @@ def env_test():
     }
     return jsonify(env_vars)
 
+# 内部キュー・スケジューラの状態確認用エンドポイント
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """バックグラウンド処理の統計を返す"""
+    return jsonify({
+        "event_dispatcher": _event_dispatcher.stats(),
+        "webhook_dedup": get_dedup_stats(),
+        "line_outbox": get_outbox_stats(),
+        "intent_fast_path": get_intent_fast_path_stats(),
+        "answer_cache": semantic_answer_cache.get_stats(),
+        "classification_memo": classification_memo.get_stats(),
+        "async_pipeline": get_async_pipeline_stats(),
+        "prompt_budget": get_prompt_budget_stats(),
+        "prefetch": get_prefetch_stats(),
+        "response_slo": get_slo_stats(),
+        "llm_routes": get_llm_route_stats(),
+        "vector_db": chroma_registry.stats(),
+        "retrieval": get_retrieval_stats(),
+        "embedding_cache": cached_embeddings.get_stats()
+    })
+
 # ルートエンドポイント
 @app.route("/", methods=["GET"])
 def root():
@@ -3649,40 +5158,514 @@ def get_recent_history(user_id, limit=5):
 
 # PDFベクトルDBからRetrieverを取得
 VECTOR_BASE = "chroma_db"
-def get_retrievers(user_profile):
-    import os
+CHROMA_PRELOAD = os.getenv("CHROMA_PRELOAD", "1") == "1"
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+# SQLiteに残す埋め込みの保持期間（秒）。古い行は1時間ごとに削除する
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 60 * 60)))
+
+class CachedEmbeddings(Embeddings):
+    """OpenAIEmbeddingsの前に置く埋め込みキャッシュ（メモリ上のLRU + SQLite）
+
+    キーは モデル名 + 正規化したテキスト のハッシュ。キャッシュにあればAPIを呼ばない。
+    埋め込むのは元のテキスト（既存のインデックスのベクトルと揃える）。
+    """
+
+    def __init__(self, max_size=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._last_purge = 0.0
+        self._inner = None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+    def _embeddings(self):
+        if self._inner is None:
+            self._inner = OpenAIEmbeddings(openai_api_key=openai_api_key)
+        return self._inner
+
+    def _key(self, text):
+        normalized = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+        return hashlib.sha256(f"{self._embeddings().model}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """キャッシュにあるベクトルを {キー: float32配列} で返す"""
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self.stats["memory_hits"] += 1
+                else:
+                    missing.append(key)
+        if not missing:
+            return found
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT text_key, embedding FROM embedding_cache WHERE text_key IN ({','.join('?' * len(missing))})",
+                missing
+            )
+            rows = cursor.fetchall()
+            conn.close()
+        except Exception as e:
+            print(f"❌ 埋め込みキャッシュ読み込みエラー: {e}")
+            rows = []
+        with self._lock:
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[key] = vector
+                self._remember(key, vector)
+                self.stats["db_hits"] += 1
+        return found
+
+    def _store(self, items):
+        """[(キー, float32配列)] をキャッシュに書き込む"""
+        with self._lock:
+            for key, vector in items:
+                self._remember(key, vector)
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            now = time.time()
+            model = self._embeddings().model
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (text_key, model, embedding, created_at) VALUES (?, ?, ?, ?)",
+                [(key, model, vector.tobytes(), now) for key, vector in items]
+            )
+            if now - self._last_purge >= 3600:
+                self._last_purge = now
+                conn.execute("DELETE FROM embedding_cache WHERE created_at < ?", (now - self.ttl,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"❌ 埋め込みキャッシュ書き込みエラー: {e}")
+
+    def embed_documents(self, texts):
+        keyed = [(self._key(text), text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(key for key, _ in keyed)))
+        pending = {}
+        for key, text in keyed:
+            if key not in found:
+                pending.setdefault(key, text)
+        if pending:
+            with self._lock:
+                self.stats["misses"] += len(pending)
+            vectors = self._embeddings().embed_documents(list(pending.values()))
+            computed = [(key, array("f", vector)) for key, vector in zip(pending, vectors)]
+            self._store(computed)
+            found.update(computed)
+        return [list(found[key]) for key, _ in keyed]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        vector = self._lookup([key]).get(key)
+        if vector is None:
+            with self._lock:
+                self.stats["misses"] += 1
+            vector = array("f", self._embeddings().embed_query(text))
+            self._store([(key, vector)])
+        return list(vector)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, size=len(self._memory))
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["db_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+cached_embeddings = CachedEmbeddings()
+
+# "unified": build_vector_index.py で作った統合コレクションを where フィルタで検索する
+# "numpy": numpy_vector_index.py で書き出した行列をプロセス内で検索する（どちらも無ければPDFごとの検索）
+VECTOR_INDEX_MODE = os.getenv("VECTOR_INDEX_MODE", "per_pdf")
+UNIFIED_VECTOR_PATH = os.getenv("UNIFIED_VECTOR_PATH", DEFAULT_UNIFIED_VECTOR_PATH)
+NUMPY_VECTOR_PATH = os.getenv("NUMPY_VECTOR_PATH", DEFAULT_NUMPY_VECTOR_PATH)
+
+class ChromaRegistry:
+    """chroma_db配下のコレクションをサブパス（self/INTJ, common など）ごとに1回だけ開いて使い回す"""
+
+    def __init__(self, base_path, unified_path=None, numpy_path=None):
+        self.base_path = base_path
+        self.unified_path = unified_path
+        self.numpy_path = numpy_path
+        self._lock = threading.Lock()
+        # サブパス -> [(PDFディレクトリ名, Chroma, retriever)]
+        self._collections = {}
+        self._unified = None
+        self._numpy_index = None
+        self.generation = 0
+        self.loaded_at = None
+
+    def _embedding_function(self):
+        return cached_embeddings
+
+    def embed_query(self, text):
+        return cached_embeddings.embed_query(text)
+
+    def _open(self, sub):
+        base_path = os.path.join(self.base_path, sub)
+        collections = []
+        if os.path.isdir(base_path):
+            for pdf_dir in sorted(os.listdir(base_path)):
+                pdf_path = os.path.join(base_path, pdf_dir)
+                if os.path.isdir(pdf_path):
+                    store = Chroma(persist_directory=pdf_path, embedding_function=self._embedding_function())
+                    collections.append((pdf_dir, store, store.as_retriever()))
+        return collections
+
+    def get_collections(self, sub):
+        """サブパスのコレクション一覧（初回だけディスクから開く）"""
+        collections = self._collections.get(sub)
+        if collections is not None:
+            return collections
+        with self._lock:
+            collections = self._collections.get(sub)
+            if collections is None:
+                collections = self._open(sub)
+                self._collections[sub] = collections
+            return collections
+
+    def get_retrievers(self, sub):
+        return [retriever for _, _, retriever in self.get_collections(sub)]
+
+    def get_unified(self):
+        """統合コレクション（作成されていなければNone）"""
+        if self._unified is not None or not self.unified_path or not os.path.isdir(self.unified_path):
+            return self._unified
+        with self._lock:
+            if self._unified is None:
+                self._unified = Chroma(
+                    collection_name=UNIFIED_COLLECTION_NAME,
+                    persist_directory=self.unified_path,
+                    embedding_function=self._embedding_function()
+                )
+            return self._unified
+
+    def get_numpy_index(self):
+        """NumPyインデックス（書き出されていなければNone）"""
+        if self._numpy_index is not None or not self.numpy_path or not os.path.isdir(self.numpy_path):
+            return self._numpy_index
+        with self._lock:
+            if self._numpy_index is None:
+                self._numpy_index = NumpyVectorIndex(self.numpy_path)
+            return self._numpy_index
+
+    def discover_sub_paths(self):
+        """chroma_db配下のサブパスを列挙（self/・partner/ は1階層下まで）"""
+        sub_paths = []
+        if not os.path.isdir(self.base_path):
+            return sub_paths
+        for top in sorted(os.listdir(self.base_path)):
+            top_path = os.path.join(self.base_path, top)
+            if not os.path.isdir(top_path):
+                continue
+            if top in ("self", "partner"):
+                sub_paths.extend(f"{top}/{name}" for name in sorted(os.listdir(top_path)) if os.path.isdir(os.path.join(top_path, name)))
+            else:
+                sub_paths.append(top)
+        return sub_paths
+
+    def build_derived_index(self, rebuild=False):
+        """unified / numpy モードで、chroma_db から作るインデックスを用意する（rebuild=Falseなら無いときだけ作る）"""
+        if not os.path.isdir(self.base_path):
+            return
+        if VECTOR_INDEX_MODE == "unified" and self.unified_path and (rebuild or not os.path.isdir(self.unified_path)):
+            build_unified_index(self.base_path, self.unified_path)
+        if VECTOR_INDEX_MODE == "numpy" and self.numpy_path and (rebuild or not os.path.isdir(self.numpy_path)):
+            export_index(self.base_path, self.numpy_path)
+
+    def preload(self):
+        """全コレクションを開いておく（統合コレクションを使うならそれだけ）"""
+        started = time.monotonic()
+        self.build_derived_index()
+        if VECTOR_INDEX_MODE == "unified":
+            if self.get_unified() is not None:
+                self.loaded_at = time.time()
+                print(f"✅ 統合ベクトルDBを読み込みました（{time.monotonic() - started:.2f}秒）")
+                return
+        if VECTOR_INDEX_MODE == "numpy":
+            index = self.get_numpy_index()
+            if index is not None:
+                self.loaded_at = time.time()
+                print(f"✅ NumPyベクトルインデックスを読み込みました（{len(index)}件, {time.monotonic() - started:.2f}秒）")
+                return
+        for sub in self.discover_sub_paths():
+            self.get_collections(sub)
+        self.loaded_at = time.time()
+        print(f"✅ ベクトルDBを読み込みました（{self.stats()['collections']}件, {time.monotonic() - started:.2f}秒）")
+
+    def reload(self):
+        """chroma_dbが差し替えられたときに呼ぶ（統合コレクション・NumPyインデックスを作り直し、開いているものを捨てて開き直す）"""
+        # 作り直しは一時ディレクトリで行って差し替えるので、その間も古いインデックスで検索できる
+        self.build_derived_index(rebuild=True)
+        with self._lock:
+            self._collections = {}
+            self._unified = None
+            self._numpy_index = None
+            self.generation += 1
+        if CHROMA_PRELOAD:
+            self.preload()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": VECTOR_INDEX_MODE,
+                "unified": self._unified is not None,
+                "numpy_rows": len(self._numpy_index) if self._numpy_index is not None else 0,
+                "sub_paths": len(self._collections),
+                "collections": sum(len(c) for c in self._collections.values()),
+                "generation": self.generation,
+                "loaded_at": self.loaded_at
+            }
+
+chroma_registry = ChromaRegistry(VECTOR_BASE, UNIFIED_VECTOR_PATH, NUMPY_VECTOR_PATH)
+
+def start_chroma_preload():
+    """起動時にバックグラウンドで全コレクションを開いておく"""
+    if not CHROMA_PRELOAD:
+        return
+
+    def preload():
+        try:
+            chroma_registry.preload()
+        except Exception as e:
+            print(f"❌ ベクトルDB読み込みエラー: {e}")
+
+    threading.Thread(target=preload, name="chroma-preload", daemon=True).start()
+
+def vector_sub_paths(user_profile):
+    """プロフィールに関係するベクトルDBのサブパスを (ソース名, サブパス) で返す"""
     sub_paths = []
 
     # self/MBTI
     if user_profile.get('mbti') and user_profile['mbti'] not in [None, '', '不明']:
-        sub_paths.append(f"self/{user_profile['mbti']}")
+        sub_paths.append(("self", f"self/{user_profile['mbti']}"))
 
     # partner/MBTI
     if user_profile.get('target_mbti') and user_profile['target_mbti'] not in [None, '', '不明']:
-        sub_paths.append(f"partner/{user_profile['target_mbti']}")
+        sub_paths.append(("partner", f"partner/{user_profile['target_mbti']}"))
 
     # gender
     if user_profile.get('gender') == '男':
-        sub_paths.append("man")
+        sub_paths.append(("gender", "man"))
     elif user_profile.get('gender') == '女':
-        sub_paths.append("woman")
+        sub_paths.append(("gender", "woman"))
 
     # common（必ず）
-    sub_paths.append("common")
+    sub_paths.append(("common", "common"))
+    return sub_paths
+
+def build_vector_filter(user_profile):
+    """統合コレクション用のwhereフィルタ（vector_sub_pathsと同じ範囲）"""
+    conditions = []
+    for source, sub in vector_sub_paths(user_profile):
+        if source in ("self", "partner"):
+            conditions.append({"$and": [{"scope": {"$eq": source}}, {"mbti": {"$eq": sub.split("/", 1)[1]}}]})
+        elif source == "gender":
+            conditions.append({"$and": [{"scope": {"$eq": "gender"}}, {"gender": {"$eq": GENDER_DIRS[sub]}}]})
+        else:
+            conditions.append({"scope": {"$eq": source}})
+    return conditions[0] if len(conditions) == 1 else {"$or": conditions}
 
+def get_unified_store():
+    """統合コレクションを使う設定で、作成済みならそれを返す"""
+    if VECTOR_INDEX_MODE != "unified":
+        return None
+    return chroma_registry.get_unified()
+
+def get_retrievers(user_profile):
+    unified = get_unified_store()
+    if unified is not None:
+        return [unified.as_retriever(search_kwargs={"filter": build_vector_filter(user_profile)})]
     retrievers = []
-    for sub in sub_paths:
-        base_path = os.path.join(VECTOR_BASE, sub)
-        if os.path.exists(base_path):
-            # PDFごとの全ディレクトリを対象にする
-            for pdf_dir in os.listdir(base_path):
-                pdf_path = os.path.join(base_path, pdf_dir)
-                if os.path.isdir(pdf_path):
-                    retrievers.append(
-                        Chroma(persist_directory=pdf_path, embedding_function=OpenAIEmbeddings()).as_retriever()
-                    )
+    for _, sub in vector_sub_paths(user_profile):
+        # PDFごとの全コレクションを対象にする（開くのはプロセス内で1回だけ）
+        retrievers.extend(chroma_registry.get_retrievers(sub))
     return retrievers
 
+# 🔎 アドバイス用の参考資料検索（関係する全コレクションを並行検索して順位融合）
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+# 埋め込み・検索にかけてよい時間（超えた分の結果は使わない）
+RETRIEVAL_BUDGET_SECONDS = float(os.getenv("RETRIEVAL_BUDGET_SECONDS", "1.5"))
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))                    # 1コレクションあたりの取得件数
+RETRIEVAL_TOP_N = int(os.getenv("RETRIEVAL_TOP_N", "4"))            # プロンプトに入れる件数
+RETRIEVAL_SOURCE_QUOTA = int(os.getenv("RETRIEVAL_SOURCE_QUOTA", "2"))  # 同じソース（self/partner/gender/common）から入れる上限
+RETRIEVAL_PASSAGE_CHARS = int(os.getenv("RETRIEVAL_PASSAGE_CHARS", "400"))
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+RRF_K = 60
+
+_retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+_retrieval_stats_lock = threading.Lock()
+_retrieval_stats = {"queries": 0, "searches": 0, "timeouts": 0, "errors": 0, "passages": 0, "latency": 0.0}
+
+def fuse_ranked_results(ranked_lists, top_n=RETRIEVAL_TOP_N, per_source_quota=RETRIEVAL_SOURCE_QUOTA, rrf_k=RRF_K):
+    """[(ソース名, 順位付きのドキュメント)] を相互順位融合し、ソースごとの上限を守って上位を返す"""
+    scores = {}
+    first_seen = {}
+    for source, documents in ranked_lists:
+        for rank, doc in enumerate(documents):
+            key = doc.page_content.strip()
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            first_seen.setdefault(key, (source, doc))
+    picked = []
+    per_source = defaultdict(int)
+    for key in sorted(scores, key=scores.get, reverse=True):
+        source, doc = first_seen[key]
+        if per_source[source] >= per_source_quota:
+            continue
+        per_source[source] += 1
+        picked.append((source, doc))
+        if len(picked) >= top_n:
+            break
+    return picked
+
+def retrieve_unified_passages(store, user_profile, query_vector):
+    """統合コレクションをwhereフィルタ付きで1回だけ検索し、ソースごとの順位で融合する"""
+    started = time.monotonic()
+    sources = vector_sub_paths(user_profile)
+    future = _retrieval_executor.submit(
+        store.similarity_search_by_vector,
+        list(query_vector), RETRIEVAL_K * len(sources), filter=build_vector_filter(user_profile)
+    )
+    timeouts = 0
+    errors = 0
+    documents = []
+    try:
+        documents = future.result(timeout=RETRIEVAL_BUDGET_SECONDS)
+    except FutureTimeoutError:
+        future.cancel()
+        timeouts = 1
+    except Exception as e:
+        errors = 1
+        print(f"❌ ベクトル検索エラー: {e}")
+    ranked = defaultdict(list)
+    for doc in documents:
+        ranked[doc.metadata.get("scope", "common")].append(doc)
+    passages = fuse_ranked_results(list(ranked.items()))
+    latency = time.monotonic() - started
+    with _retrieval_stats_lock:
+        _retrieval_stats["queries"] += 1
+        _retrieval_stats["searches"] += 1
+        _retrieval_stats["timeouts"] += timeouts
+        _retrieval_stats["errors"] += errors
+        _retrieval_stats["passages"] += len(passages)
+        _retrieval_stats["latency"] += latency
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(
+            f"[retrieve_passages] unified timeouts={timeouts} errors={errors} "
+            f"passages={[source for source, _ in passages]} in {latency:.2f}s\n"
+        )
+    return passages
+
+def retrieve_numpy_passages(index, user_profile, query_vector):
+    """NumPyインデックスをサブパスごとにtop-k検索し、順位融合する（ネットワーク・DBアクセスなし）"""
+    started = time.monotonic()
+    sources = vector_sub_paths(user_profile)
+    hits = index.search(query_vector, RETRIEVAL_K, [sub for _, sub in sources])[0]
+    ranked_lists = [
+        (source, [
+            Document(page_content=index.rows[row]["text"], metadata=index.rows[row]["metadata"])
+            for row, _ in hits.get(sub, [])
+        ])
+        for source, sub in sources
+    ]
+    passages = fuse_ranked_results(ranked_lists)
+    latency = time.monotonic() - started
+    with _retrieval_stats_lock:
+        _retrieval_stats["queries"] += 1
+        _retrieval_stats["searches"] += len(sources)
+        _retrieval_stats["passages"] += len(passages)
+        _retrieval_stats["latency"] += latency
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[retrieve_passages] numpy passages={[source for source, _ in passages]} in {latency:.3f}s\n")
+    return passages
+
+def retrieve_passages(user_profile, question, query_vector=None):
+    """関係する全コレクションを共通の質問埋め込みで並行検索し、順位融合した (ソース名, ドキュメント) を返す"""
+    unified = get_unified_store()
+    if unified is not None:
+        if query_vector is None:
+            query_vector = chroma_registry.embed_query(question)
+        return retrieve_unified_passages(unified, user_profile, query_vector)
+    numpy_index = chroma_registry.get_numpy_index() if VECTOR_INDEX_MODE == "numpy" else None
+    if numpy_index is not None:
+        if query_vector is None:
+            query_vector = chroma_registry.embed_query(question)
+        return retrieve_numpy_passages(numpy_index, user_profile, query_vector)
+    started = time.monotonic()
+    deadline = started + RETRIEVAL_BUDGET_SECONDS
+    collections = [
+        (source, store)
+        for source, sub in vector_sub_paths(user_profile)
+        for _, store, _ in chroma_registry.get_collections(sub)
+    ]
+    if not collections:
+        return []
+    if query_vector is None:
+        query_vector = chroma_registry.embed_query(question)
+    query_vector = list(query_vector)
+    futures = [
+        (_retrieval_executor.submit(store.similarity_search_by_vector, query_vector, RETRIEVAL_K), source)
+        for source, store in collections
+    ]
+    done, not_done = futures_wait([future for future, _ in futures], timeout=max(0.0, deadline - time.monotonic()))
+    ranked_lists = []
+    errors = 0
+    for future, source in futures:
+        if future not in done:
+            future.cancel()
+            continue
+        try:
+            ranked_lists.append((source, future.result()))
+        except Exception as e:
+            errors += 1
+            print(f"❌ ベクトル検索エラー: {e}")
+    passages = fuse_ranked_results(ranked_lists)
+    latency = time.monotonic() - started
+    with _retrieval_stats_lock:
+        _retrieval_stats["queries"] += 1
+        _retrieval_stats["searches"] += len(futures)
+        _retrieval_stats["timeouts"] += len(not_done)
+        _retrieval_stats["errors"] += errors
+        _retrieval_stats["passages"] += len(passages)
+        _retrieval_stats["latency"] += latency
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(
+            f"[retrieve_passages] collections={len(futures)} timeouts={len(not_done)} errors={errors} "
+            f"passages={[source for source, _ in passages]} in {latency:.2f}s\n"
+        )
+    return passages
+
+def format_passages(passages):
+    """参考資料をプロンプト用の箇条書きにする"""
+    lines = ["以下の資料も参考にしてね（そのまま引用せず、自分の言葉で活かしてね）"]
+    for _, doc in passages:
+        text = re.sub(r"\s+", " ", doc.page_content).strip()
+        if len(text) > RETRIEVAL_PASSAGE_CHARS:
+            text = text[:RETRIEVAL_PASSAGE_CHARS] + "…"
+        lines.append(f"- {text}")
+    return "\n".join(lines)
+
+def get_retrieval_stats():
+    with _retrieval_stats_lock:
+        queries = _retrieval_stats["queries"]
+        return {
+            "enabled": RETRIEVAL_ENABLED,
+            "budget_seconds": RETRIEVAL_BUDGET_SECONDS,
+            **{k: v for k, v in _retrieval_stats.items() if k != "latency"},
+            "avg_latency": _retrieval_stats["latency"] / queries if queries else 0.0
+        }
+
 def get_qa_chain(user_profile):
     retrievers = get_retrievers(user_profile)
     print("retrievers len:", len(retrievers))
@@ -3697,7 +5680,7 @@ def get_qa_chain(user_profile):
         print("⚠️ OpenAI APIキーが設定されていません")
         raise ValueError("OpenAI APIキーが設定されていません")
     
-    llm = ChatOpenAI(openai_api_key=openai_api_key)
+    llm = get_llm("qa")
     return RetrievalQA.from_chain_type(llm=llm, retriever=retriever), llm
 
 # --- AI質問受付エンドポイント ---
@@ -3734,48 +5717,400 @@ def upload_db():
     except Exception as e:
         return jsonify({"error": f"アップロードエラー: {str(e)}"}), 500
 
-# --- AI応答ロジックを関数化 ---
-def ask_ai_with_vector_db(user_id, question, user_profile, question_type="一般的な相談"):
-    os.makedirs("/data/logs", exist_ok=True)
-    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-        f.write(f"[ask_ai_with_vector_db] user_id={user_id}, question={question}, user_profile={user_profile}\n")
-    if not question:
-        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write("[ask_ai_with_vector_db] question is empty\n")
-        return "質問が空だよ😅"
-    if not user_profile.get("is_paid"):
-        with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write("[ask_ai_with_vector_db] user is not paid\n")
-        return "有料会員のみ利用できるよ！"
-    history = get_recent_history(user_id)
+@app.route("/reload_vector_db", methods=["POST"])
+def reload_vector_db():
+    """chroma_dbを差し替えた後に呼び、開いているコレクションを読み込み直す（unified / numpy モードは作り直してから）"""
+    reload_token = os.getenv("VECTOR_DB_RELOAD_TOKEN")
+    if not reload_token or request.headers.get("X-Reload-Token") != reload_token:
+        return jsonify({"error": "forbidden"}), 403
     try:
-        if not openai_api_key or openai_api_key == "dummy_key_for_development":
-            print("⚠️ OpenAI APIキーが設定されていません")
-            return "ごめんね、AI機能が一時的に利用できないよ😅 しばらく待ってから再度お試ししてね！"
-        
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.8,            # 柔らかく多様な表現に
-            frequency_penalty=0.7,      # 同じ表現を避ける
-            presence_penalty=0.6,       # 新しい話題を促す
-            openai_api_key=openai_api_key
+        chroma_registry.reload()
+        return jsonify({"message": "ベクトルDBを読み込み直しました", **chroma_registry.stats()}), 200
+    except Exception as e:
+        return jsonify({"error": f"読み込みエラー: {str(e)}"}), 500
+
+# 🧮 トークン数の計測（tiktoken）
+_token_encoding = None
+
+def count_tokens(text):
+    """gpt-3.5-turboのトークナイザでトークン数を数える"""
+    global _token_encoding
+    if _token_encoding is None:
+        _token_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return len(_token_encoding.encode(text or ""))
+
+# 🧮 アドバイス用プロンプトのトークン予算
+ADVICE_PROMPT_TOKEN_BUDGET = int(os.getenv("ADVICE_PROMPT_TOKEN_BUDGET", "6000"))
+# "prefix_cache": 共通の指示を先頭に置き、OpenAIのプレフィックスキャッシュが効く並び順にする
+ADVICE_PROMPT_LAYOUT = os.getenv("ADVICE_PROMPT_LAYOUT", "legacy")
+PROMPT_TRUNCATION_MARKER = "…（省略）"
+
+_prompt_budget_lock = threading.Lock()
+_prompt_budget_stats = {"prompts": 0, "truncated": 0, "tokens": 0, "max_tokens": 0, "reused_prefix_tokens": 0}
+
+class PromptBudget:
+    """セクション単位でプロンプトを組み立て、予算を超えたら優先度の低いセクションから行単位で削る
+
+    priority: 小さいほど先に削る（Noneは削らない）
+    trim: "tail"=末尾から / "head"=先頭から（古い履歴から） / "middle"=中央から（前置きと末尾の質問は残す）
+    """
+
+    def __init__(self, budget=ADVICE_PROMPT_TOKEN_BUDGET):
+        self.budget = budget
+        self.sections = []
+        self._rendered = []
+
+    def add(self, name, body, header=None, priority=None, trim="tail"):
+        self.sections.append({
+            "name": name,
+            "header": header,
+            "lines": body.split("\n"),
+            "priority": priority,
+            "trim": trim,
+            "removed": set()
+        })
+
+    @staticmethod
+    def _removal_order(count, trim):
+        if trim == "head":
+            return list(range(count))
+        if trim == "middle":
+            center = (count - 1) / 2
+            return sorted(range(count), key=lambda i: abs(i - center))
+        return list(range(count - 1, -1, -1))
+
+    @staticmethod
+    def _section_text(section):
+        if len(section["removed"]) == len(section["lines"]):
+            return ""
+        lines = [section["header"]] if section["header"] else []
+        marked = False
+        for i, line in enumerate(section["lines"]):
+            if i not in section["removed"]:
+                lines.append(line)
+            elif not marked:
+                lines.append(PROMPT_TRUNCATION_MARKER)
+                marked = True
+        return "\n".join(lines)
+
+    def _trim(self, overflow):
+        marker_tokens = count_tokens(PROMPT_TRUNCATION_MARKER) + 1
+        for section in sorted((s for s in self.sections if s["priority"] is not None), key=lambda s: s["priority"]):
+            if overflow <= 0:
+                return
+            line_tokens = [count_tokens(line) + 1 for line in section["lines"]]
+            overflow += marker_tokens
+            for i in self._removal_order(len(section["lines"]), section["trim"]):
+                if overflow <= 0:
+                    break
+                section["removed"].add(i)
+                overflow -= line_tokens[i]
+            if len(section["removed"]) == len(section["lines"]):
+                # 本文がすべて消えたら見出しごと外す
+                overflow -= marker_tokens + (count_tokens(section["header"]) + 1 if section["header"] else 0)
+
+    def render(self):
+        """(プロンプト本文, {セクション名: (削る前, 削った後)}) を返す"""
+        before = {s["name"]: count_tokens(self._section_text(s)) for s in self.sections}
+        self._trim(sum(before.values()) - self.budget)
+        texts = {s["name"]: self._section_text(s) for s in self.sections}
+        breakdown = {name: (before[name], count_tokens(text)) for name, text in texts.items()}
+        self._rendered = [(text, breakdown[name][1]) for name, text in texts.items() if text]
+        return "\n\n".join(text for text, _ in self._rendered), breakdown
+
+    def rendered_sections(self):
+        """render後の (セクション本文, トークン数) を先頭から順に返す"""
+        return list(self._rendered)
+
+def log_prompt_budget(tag, prompt_tokens, budget, breakdown, reused_prefix_tokens=0):
+    """セクションごとのトークン数をログと統計に残す"""
+    truncated = any(after < before for before, after in breakdown.values())
+    parts = " ".join(
+        f"{name}={before}" if before == after else f"{name}={before}->{after}"
+        for name, (before, after) in breakdown.items()
+    )
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(
+            f"[{tag}] prompt tokens: {prompt_tokens}/{budget}{' (truncated)' if truncated else ''} {parts}"
+            f" reused_prefix={reused_prefix_tokens}\n"
         )
-        
-        # パーソナライズされたアドバイスコンテキストを生成
-        personality_context = generate_personalized_advice(user_profile, question, history, question_type)
-        
-        # より明確で効果的なプロンプトを構築
-        prompt = f"""
-{personality_context}
+    with _prompt_budget_lock:
+        _prompt_budget_stats["prompts"] += 1
+        _prompt_budget_stats["truncated"] += truncated
+        _prompt_budget_stats["tokens"] += prompt_tokens
+        _prompt_budget_stats["max_tokens"] = max(_prompt_budget_stats["max_tokens"], prompt_tokens)
+        _prompt_budget_stats["reused_prefix_tokens"] += reused_prefix_tokens
+
+def get_prompt_budget_stats():
+    with _prompt_budget_lock:
+        prompts = _prompt_budget_stats["prompts"]
+        return {
+            "budget": ADVICE_PROMPT_TOKEN_BUDGET,
+            "prompts": prompts,
+            "truncated": _prompt_budget_stats["truncated"],
+            "avg_tokens": _prompt_budget_stats["tokens"] / prompts if prompts else 0.0,
+            "max_tokens": _prompt_budget_stats["max_tokens"],
+            "layout": ADVICE_PROMPT_LAYOUT,
+            "avg_reused_prefix_tokens": _prompt_budget_stats["reused_prefix_tokens"] / prompts if prompts else 0.0,
+            "reused_prefix_ratio": _prompt_budget_stats["reused_prefix_tokens"] / _prompt_budget_stats["tokens"] if _prompt_budget_stats["tokens"] else 0.0
+        }
+
+# 🔁 プロンプト先頭の使い回し状況（OpenAIのプレフィックスキャッシュが効くトークン数の見積もり）
+PREFIX_CACHE_TTL = float(os.getenv("PREFIX_CACHE_TTL", "600"))
+# OpenAIは1024トークン以上の共通プレフィックスからキャッシュする
+PREFIX_CACHE_MIN_TOKENS = int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "1024"))
+
+class PrefixReuseTracker:
+    """最近送ったプロンプトと先頭から何トークン一致しているかをセクション境界単位で見積もる"""
+
+    def __init__(self, ttl=PREFIX_CACHE_TTL, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # 先頭からのセクション列のハッシュ -> 最後に送った時刻
+        self._lock = threading.Lock()
+
+    def observe(self, sections):
+        """(セクション本文, トークン数) の列を記録し、使い回せる先頭のトークン数を返す"""
+        now = time.monotonic()
+        digest = hashlib.sha256()
+        prefix_tokens = 0
+        reused = 0
+        with self._lock:
+            for text, tokens in sections:
+                digest.update(text.encode("utf-8") + b"\0")
+                key = digest.hexdigest()
+                seen_at = self._seen.get(key)
+                prefix_tokens += tokens
+                # 直前のセクションまで一致していた場合だけ一致を伸ばす
+                if seen_at is not None and now - seen_at <= self.ttl and reused == prefix_tokens - tokens:
+                    reused = prefix_tokens
+                self._seen[key] = now
+                self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+        return reused if reused >= PREFIX_CACHE_MIN_TOKENS else 0
+
+prefix_reuse_tracker = PrefixReuseTracker()
+
+# 🗃️ 恋愛相談の意味的回答キャッシュ（プロフィール + 質問タイプ + 質問の埋め込み）
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 60 * 60)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+
+def normalize_question(text):
+    """キャッシュ照合用に質問を正規化（NFKC・空白の統一）"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+def _unit_vector(values):
+    """コサイン類似度を内積で計算できるよう正規化したfloat32配列"""
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return array("f", (v / norm for v in values))
+
+class SemanticAnswerCache:
+    """似た質問への回答を使い回すキャッシュ（SQLite永続化 + メモリ上のLRU）"""
+
+    def __init__(self):
+        self._entries = OrderedDict()   # id -> エントリ（末尾ほど最近使われた）
+        self._by_key = defaultdict(set)  # (profile_key, question_type) -> id集合
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.stats = {"lookups": 0, "hits": 0, "saved_tokens": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def profile_key(user_profile):
+        return f"{user_profile.get('mbti', '不明')}|{user_profile.get('target_mbti', '不明')}|{user_profile.get('gender', '不明')}"
 
-【チャット履歴】
-{chr(10).join(history) if history else "初回の相談だよ！"}
+    def _embed(self, question):
+        return _unit_vector(cached_embeddings.embed_query(normalize_question(question)))
 
-【履歴分析】
-{analyze_chat_history(history, user_profile) if history else "初回の相談だから、過去の相談内容はないよ！"}
+    def _load(self):
+        """SQLiteから期限内のエントリを読み込む（初回のみ）"""
+        if self._loaded:
+            return
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM answer_cache WHERE created_at < ?", (time.time() - ANSWER_CACHE_TTL,))
+        conn.commit()
+        cursor.execute(
+            "SELECT id, profile_key, question_type, embedding, answer, tokens, created_at FROM answer_cache ORDER BY last_used_at DESC LIMIT ?",
+            (ANSWER_CACHE_MAX_ENTRIES,)
+        )
+        for row in reversed(cursor.fetchall()):
+            vector = array("f")
+            vector.frombytes(row[3])
+            self._add_entry(row[0], row[1], row[2], vector, row[4], row[5], row[6])
+        conn.close()
+        self._loaded = True
+
+    def _add_entry(self, entry_id, profile_key, question_type, vector, answer, tokens, created_at):
+        self._entries[entry_id] = {
+            "key": (profile_key, question_type),
+            "vector": vector,
+            "answer": answer,
+            "tokens": tokens,
+            "created_at": created_at
+        }
+        self._by_key[(profile_key, question_type)].add(entry_id)
+
+    def _remove_entry(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._by_key[entry["key"]].discard(entry_id)
+
+    def lookup(self, user_profile, question_type, question):
+        """(キャッシュ済みの回答 or None, 質問の埋め込み) を返す"""
+        vector = self._embed(question)
+        key = (self.profile_key(user_profile), question_type)
+        now = time.time()
+        with self._lock:
+            self._load()
+            self.stats["lookups"] += 1
+            candidates = []
+            for entry_id in list(self._by_key.get(key, ())):
+                entry = self._entries[entry_id]
+                if now - entry["created_at"] > ANSWER_CACHE_TTL:
+                    self._remove_entry(entry_id)
+                    continue
+                candidates.append((entry_id, entry["vector"]))
+        # 類似度の計算はロックの外で行う（他のスレッドの検索・保存を待たせない）
+        best_id, best_score = None, 0.0
+        if candidates:
+            matrix = np.frombuffer(b"".join(v.tobytes() for _, v in candidates), dtype=np.float32).reshape(len(candidates), -1)
+            scores = matrix @ np.frombuffer(vector.tobytes(), dtype=np.float32)
+            best = int(np.argmax(scores))
+            best_id, best_score = candidates[best][0], float(scores[best])
+        if best_id is None or best_score < ANSWER_CACHE_SIMILARITY:
+            return None, vector
+        with self._lock:
+            entry = self._entries.get(best_id)
+            if entry is None:
+                # 計算している間に削除された
+                return None, vector
+            self._entries.move_to_end(best_id)
+            self.stats["hits"] += 1
+            self.stats["saved_tokens"] += entry["tokens"]
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=30)
+            conn.execute("UPDATE answer_cache SET hits=hits+1, last_used_at=? WHERE id=?", (now, best_id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"❌ 回答キャッシュ更新エラー: {e}")
+        print(f"🗃️ 回答キャッシュヒット: similarity={best_score:.4f}")
+        return entry["answer"], vector
+
+    def store(self, user_profile, question_type, question, answer, tokens, vector):
+        """生成した回答をキャッシュに保存（上限を超えたら最も使われていないものから削除）"""
+        profile_key = self.profile_key(user_profile)
+        now = time.time()
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO answer_cache (profile_key, question_type, question, embedding, answer, tokens, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (profile_key, question_type, question, vector.tobytes(), answer, tokens, now, now)
+        )
+        entry_id = cursor.lastrowid
+        evicted = []
+        with self._lock:
+            self._load()
+            self._add_entry(entry_id, profile_key, question_type, vector, answer, tokens, now)
+            self.stats["stores"] += 1
+            while len(self._entries) > ANSWER_CACHE_MAX_ENTRIES:
+                oldest_id = next(iter(self._entries))
+                self._remove_entry(oldest_id)
+                evicted.append(oldest_id)
+            self.stats["evictions"] += len(evicted)
+        cursor.executemany("DELETE FROM answer_cache WHERE id=?", [(i,) for i in evicted])
+        conn.commit()
+        conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._entries))
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        return stats
+
+semantic_answer_cache = SemanticAnswerCache()
+
+# 💬 ストリーミング生成を文の区切りで吹き出しに分けて順に送る
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") == "1"
+STREAM_FIRST_BUBBLE_CHARS = int(os.getenv("STREAM_FIRST_BUBBLE_CHARS", "40"))
+STREAM_BUBBLE_CHARS = int(os.getenv("STREAM_BUBBLE_CHARS", "400"))
+
+# 文末（後ろに続く閉じ括弧・絵文字・空白も含める）または改行
+_SENTENCE_BOUNDARY_RE = re.compile(r"[。！？!?]+[」』）)\s\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F]*|\n+")
 
-【回答の品質向上のための指示】
-1. **MBTI組み合わせを活用**: 『{user_profile.get('mbti', '不明')}』のあなたが『{user_profile.get('target_mbti', '不明')}』の相手に対して取るべき最適なアプローチを提案してね
+class BubbleSplitter:
+    """ストリーミングの断片を溜め、文の区切りで吹き出し単位に切り出す"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.limit = STREAM_FIRST_BUBBLE_CHARS
+
+    def feed(self, chunk):
+        """断片を追加し、切り出せた吹き出し（なければNone）を返す"""
+        self.buffer += chunk
+        if len(self.buffer) < self.limit:
+            return None
+        cut = 0
+        for match in _SENTENCE_BOUNDARY_RE.finditer(self.buffer):
+            # 末尾ぴったりの区切りは続きの絵文字が来るかもしれないので待つ
+            if match.end() < len(self.buffer):
+                cut = match.end()
+        if cut == 0:
+            return None
+        bubble, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+        if not bubble:
+            return None
+        self.limit = STREAM_BUBBLE_CHARS
+        return bubble
+
+    def finish(self):
+        """残りを最後の吹き出しとして返す"""
+        bubble, self.buffer = self.buffer.strip(), ""
+        return bubble or None
+
+def iter_stream_bubbles(chunks):
+    """トークンの断片を受け取り、文の区切りでまとめた吹き出しを順に返す"""
+    splitter = BubbleSplitter()
+    for chunk in chunks:
+        bubble = splitter.feed(chunk)
+        if bubble:
+            yield bubble
+    bubble = splitter.finish()
+    if bubble:
+        yield bubble
+
+def stream_answer_to_batch(route, prompt, batch, prompt_tokens=None):
+    """回答をストリーミング生成して吹き出しごとにbatchへ送り、(回答全文, 送信したか) を返す
+    最初の吹き出しはリプライ、以降はまとめてプッシュ（残りはbatchの最後のflushで届く）"""
+    started = time.monotonic()
+    bubbles = []
+    try:
+        for bubble in iter_stream_bubbles(chunk.content for chunk in get_llm(route).stream(prompt)):
+            if not bubbles:
+                with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+                    f.write(f"[stream_answer_to_batch] first bubble after {time.monotonic() - started:.2f}s\n")
+            bubbles.append(bubble)
+            batch.stream(bubble)
+    except Exception:
+        record_llm_call(route, started, prompt, prompt_tokens=prompt_tokens)
+        raise
+    record_llm_call(route, started, prompt, "".join(bubbles), prompt_tokens)
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[stream_answer_to_batch] {len(bubbles)} bubbles in {time.monotonic() - started:.2f}s\n")
+    return "\n".join(bubbles), bool(bubbles)
+
+# --- AI応答ロジックを関数化 ---
+def build_advice_rules(user_profile=None):
+    """回答の品質・口調に関する指示（トークン予算の対象外）
+    user_profileを省略すると組み合わせに依存しない固定の文面になる（プレフィックスキャッシュ用）"""
+    if user_profile is None:
+        combination = "下の【MBTI組み合わせ分析】にあるあなたが相手"
+    else:
+        combination = f"『{user_profile.get('mbti', '不明')}』のあなたが『{user_profile.get('target_mbti', '不明')}』の相手"
+    return f"""【回答の品質向上のための指示】
+1. **MBTI組み合わせを活用**: {combination}に対して取るべき最適なアプローチを提案してね
 2. **自然な会話**: 友達がアドバイスしているような自然な会話の流れを心がけてね
 3. **親しみやすい表現**: 「あなた」「君」と呼びかけ、絶対にタメ口で絵文字を適度に使ってね
 4. **具体的で実践的**: 抽象的なアドバイスではなく、すぐに実行できる具体的なステップを提供してね
@@ -3797,37 +6132,152 @@ def ask_ai_with_vector_db(user_id, question, user_profile, question_type="一般
 【相手の表現について】
 - 「相手」「彼/彼女」「好きな人」「気になる人」などの自然な表現を使う
 - 「友達の〜の人」「知り合いの〜の人」のような表現は絶対に使わない
-- 相手を「相手」と呼ぶか、状況に応じて「彼/彼女」を使う
-"""
-        
-        answer = llm.invoke(prompt).content
+- 相手を「相手」と呼ぶか、状況に応じて「彼/彼女」を使う"""
+
+def build_advice_prompt(user_profile, question, history, question_type="一般的な相談", passages=None):
+    """アドバイス用プロンプトをセクション単位で組み立てる（ADVICE_PROMPT_LAYOUTで並び順を切り替え）
+    予算を超えたら古い履歴 → 履歴分析 → 参考資料 → ペルソナの順に削り、指示と質問は削らない"""
+    history_text = chr(10).join(history) if history else "初回の相談だよ！"
+    analysis_text = analyze_chat_history(history, user_profile) if history else "初回の相談だから、過去の相談内容はないよ！"
+    budget = PromptBudget()
+
+    def add_references():
+        if passages:
+            budget.add("references", format_passages(passages), header="【参考資料】", priority=3)
+
+    if ADVICE_PROMPT_LAYOUT == "prefix_cache":
+        # 全員共通の指示 → 組み合わせごとのペルソナ → ユーザーごとの履歴と質問 の順に並べ、先頭ほど使い回せるようにする
+        common, pair = split_persona_block(get_persona_block(
+            user_profile.get('mbti', '不明'), user_profile.get('target_mbti', '不明'), user_profile.get('gender', '不明')
+        ))
+        budget.add("common", common.strip("\n") + "\n\n" + build_advice_rules())
+        budget.add("persona", pair, priority=4, trim="middle")
+        add_references()
+        budget.add("history", history_text, header="【チャット履歴】", priority=1, trim="head")
+        budget.add("analysis", analysis_text, header="【履歴分析】", priority=2)
+        budget.add("request", build_advice_directives(user_profile, question, history).strip("\n"))
+    else:
+        # ペルソナ（削れる）と、質問を含むリクエストごとの指示（削らない）を分けて並べる
+        persona = get_persona_block(
+            user_profile.get('mbti', '不明'), user_profile.get('target_mbti', '不明'), user_profile.get('gender', '不明')
+        )
+        # セクションごとにトークン数を数え、予算を超える分は優先度の低い順に削る
+        budget.add("persona", persona.rstrip("\n"), priority=4, trim="middle")
+        budget.add("request", build_advice_directives(user_profile, question, history).lstrip("\n"))
+        add_references()
+        budget.add("history", history_text, header="【チャット履歴】", priority=1, trim="head")
+        budget.add("analysis", analysis_text, header="【履歴分析】", priority=2)
+        budget.add("rules", build_advice_rules(user_profile))
+    return budget
+
+def prepare_advice_request(user_id, question, user_profile, question_type="一般的な相談", history=None):
+    """回答生成の前処理（入力チェック・履歴・回答キャッシュ・プロンプト構築）
+    すぐに返せる回答があれば (回答, None)、生成が必要なら (None, 生成リクエスト) を返す"""
+    os.makedirs("/data/logs", exist_ok=True)
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[ask_ai_with_vector_db] user_id={user_id}, question={question}, user_profile={user_profile}\n")
+    if not question:
         with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write(f"[ask_ai_with_vector_db] LLM only answer: {answer}\n")
-        save_message(user_id, "user", question)
-        save_message(user_id, "bot", answer)
-        return answer
-    except Exception as e:
-        import traceback
+            f.write("[ask_ai_with_vector_db] question is empty\n")
+        return "質問が空だよ😅", None
+    if not user_profile.get("is_paid"):
         with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
-            f.write(f"[ask_ai_with_vector_db] Exception: {e}\n")
-            f.write(traceback.format_exc() + "\n")
-        traceback.print_exc()
+            f.write("[ask_ai_with_vector_db] user is not paid\n")
+        return "有料会員のみ利用できるよ！", None
+    try:
+        if history is None:
+            prefetch = current_chat_prefetch(user_id, question)
+            history = prefetch.history() if prefetch else get_recent_history(user_id)
+        if not openai_api_key or openai_api_key == "dummy_key_for_development":
+            print("⚠️ OpenAI APIキーが設定されていません")
+            return "ごめんね、AI機能が一時的に利用できないよ😅 しばらく待ってから再度お試ししてね！", None
+        
+        # 同じプロフィールの似た質問に回答済みならそれを返す
+        question_vector = None
+        if ANSWER_CACHE_ENABLED:
+            try:
+                cached_answer, question_vector = semantic_answer_cache.lookup(user_profile, question_type, question)
+            except Exception as e:
+                print(f"❌ 回答キャッシュ検索エラー: {e}")
+                cached_answer = None
+            if cached_answer:
+                with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+                    f.write(f"[ask_ai_with_vector_db] cache hit: {cached_answer}\n")
+                save_message(user_id, "user", question)
+                save_message(user_id, "bot", cached_answer)
+                return cached_answer, None
+        
+        # 関係するベクトルDBから参考資料を集める（質問の埋め込みは回答キャッシュと共有）
+        passages = []
+        if RETRIEVAL_ENABLED:
+            try:
+                passages = retrieve_passages(user_profile, question, question_vector)
+            except Exception as e:
+                print(f"❌ 参考資料の検索エラー: {e}")
+        budget = build_advice_prompt(user_profile, question, history, question_type, passages)
+        body, breakdown = budget.render()
+        prompt = f"\n{body}\n"
+        prompt_tokens = count_tokens(prompt)
+        reused_prefix_tokens = prefix_reuse_tracker.observe(budget.rendered_sections())
+        log_prompt_budget("ask_ai_with_vector_db", prompt_tokens, budget.budget, breakdown, reused_prefix_tokens)
+        
+        # 会話履歴を含むプロンプトの回答には本人の事情が入りうるので、同じプロフィールの他人には使い回さない
+        return None, {
+            "prompt": prompt,
+            "prompt_tokens": prompt_tokens,
+            "question_vector": question_vector,
+            "cacheable": not history
+        }
+    except Exception as e:
+        log_advice_error(e)
+        return "AI応答中にエラーが発生しました。", None
+
+def finish_advice_request(user_id, question, user_profile, question_type, advice, answer):
+    """生成した回答を履歴と回答キャッシュに保存"""
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[ask_ai_with_vector_db] LLM only answer: {answer}\n")
+    save_message(user_id, "user", question)
+    save_message(user_id, "bot", answer)
+    if advice["cacheable"] and advice["question_vector"] is not None:
+        try:
+            semantic_answer_cache.store(
+                user_profile, question_type, question, answer,
+                advice["prompt_tokens"] + count_tokens(answer), advice["question_vector"]
+            )
+        except Exception as e:
+            print(f"❌ 回答キャッシュ保存エラー: {e}")
+    return answer
+
+def log_advice_error(e):
+    with open("/data/logs/debug.log", "a", encoding="utf-8") as f:
+        f.write(f"[ask_ai_with_vector_db] Exception: {e}\n")
+        f.write(traceback.format_exc() + "\n")
+    traceback.print_exc()
+
+def ask_ai_with_vector_db(user_id, question, user_profile, question_type="一般的な相談"):
+    early_answer, advice = prepare_advice_request(user_id, question, user_profile, question_type)
+    if advice is None:
+        return early_answer
+    try:
+        # LINEイベントの処理中なら文ごとに送りながら生成する
+        batch = current_outbound_batch()
+        if STREAMING_ENABLED and batch is not None and batch.user_id == user_id:
+            answer, delivered = stream_answer_to_batch("advice", advice["prompt"], batch, advice["prompt_tokens"])
+        else:
+            answer, delivered = invoke_llm("advice", advice["prompt"], advice["prompt_tokens"]), False
+        answer = finish_advice_request(user_id, question, user_profile, question_type, advice, answer)
+        # 吹き出しで送信済みなら、呼び出し元から送るものはない
+        return None if delivered else answer
+    except Exception as e:
+        log_advice_error(e)
         return "AI応答中にエラーが発生しました。"
 
 # MBTI別のパーソナライズされたアドバイス生成関数
-def generate_personalized_advice(user_profile, question, history, question_type="一般的な相談"):
-    """MBTI別の性格特徴を活用したパーソナライズされたアドバイスを生成"""
+def build_advice_directives(user_profile, question, history):
+    """繰り返し回避・回答スタイル・質問のブロックを作成（リクエストごとに変わる部分）"""
     import random
     
     user_mbti = user_profile.get('mbti', '不明')
-    user_gender = user_profile.get('gender', '不明')
-    target_mbti = user_profile.get('target_mbti', '不明')
-    
-    # ユーザーと相手のMBTI情報を取得
-    user_personality = MBTI_PERSONALITY.get(user_mbti, {})
-    target_personality = MBTI_PERSONALITY.get(target_mbti, {})
-    user_nickname = MBTI_NICKNAME.get(user_mbti, "恋愛探検家")
-    target_nickname = MBTI_NICKNAME.get(target_mbti, "恋愛相手")
     
     # 過去の会話から繰り返しパターンを検出
     recent_responses = []
@@ -3894,6 +6344,23 @@ def generate_personalized_advice(user_profile, question, history, question_type=
         else:
             style = random.choice(["dialogue_format", "story_format", "emotional", "tips_format"])
     
+    return f"""
+【繰り返しを避けるための指示】
+以下の表現は最近の回答で多用されているため、今回の回答では避けてください：
+{', '.join(avoid_keywords) if avoid_keywords else '特に制限なし'}
+
+【回答スタイル】
+{style}形式で、具体的で実践的なアドバイスを提供してください。
+
+【質問】
+{question}
+"""
+
+def build_persona_block(user_mbti, target_mbti, user_gender):
+    """【基本ルール】〜【相性分析】のブロックを作成（MBTIの組み合わせと性別だけで決まる）"""
+    user_personality = MBTI_PERSONALITY.get(user_mbti, {})
+    target_personality = MBTI_PERSONALITY.get(target_mbti, {})
+    
     # 詳細な相性分析
     compatibility_notes = ""
     if user_mbti != '不明' and target_mbti != '不明':
@@ -3926,8 +6393,7 @@ def generate_personalized_advice(user_profile, question, history, question_type=
 相手の特徴を活かしたアプローチが特に重要だから、お互いの違いを楽しみながら理解を深めていこう！
 長期的には非常に充実した関係を築ける可能性があるから、焦らずに進めていってね。"""
     
-    # より明確で効果的なプロンプトを構築
-    personality_context = f"""
+    return f"""
 あなたは恋愛マスターの女友達です。
 
 【基本ルール】
@@ -3984,20 +6450,37 @@ def generate_personalized_advice(user_profile, question, history, question_type=
 
 【相性分析】
 {compatibility_notes}
+"""
 
-【繰り返しを避けるための指示】
-以下の表現は最近の回答で多用されているため、今回の回答では避けてください：
-{', '.join(avoid_keywords) if avoid_keywords else '特に制限なし'}
+# 📚 組み合わせごとのペルソナブロック（起動時に16×16×性別3パターンを組み立てておく）
+PERSONA_GENDERS = ["男", "女", "不明"]
 
-【回答スタイル】
-{style}形式で、具体的で実践的なアドバイスを提供してください。
+def precompile_persona_blocks():
+    started = time.monotonic()
+    blocks = {
+        (user_mbti, target_mbti, gender): build_persona_block(user_mbti, target_mbti, gender)
+        for user_mbti in MBTI_PERSONALITY
+        for target_mbti in MBTI_PERSONALITY
+        for gender in PERSONA_GENDERS
+    }
+    print(f"✅ ペルソナブロックを{len(blocks)}件作成しました（{time.monotonic() - started:.2f}秒）")
+    return blocks
 
-【質問】
-{question}
-"""
+PERSONA_BLOCKS = precompile_persona_blocks()
 
-    
-    return personality_context
+def split_persona_block(block):
+    """ペルソナブロックを全組み合わせ共通の前置きと、組み合わせごとの部分に分ける"""
+    index = block.find("【MBTI組み合わせ分析】")
+    if index < 0:
+        return "", block
+    return block[:index], block[index:]
+
+def get_persona_block(user_mbti, target_mbti, user_gender):
+    """事前に作成したペルソナブロックを返す（未登録の組み合わせはその場で作成）"""
+    block = PERSONA_BLOCKS.get((user_mbti, target_mbti, user_gender))
+    if block is None:
+        block = build_persona_block(user_mbti, target_mbti, user_gender)
+    return block
 
 # 豊富なレスポンスパターンの定義
 RESPONSE_PATTERNS = {
@@ -4119,6 +6602,11 @@ def get_random_response_pattern(pattern_type, user_profile, question_type=None):
         return random.choice(patterns).format(nickname=nickname)
     return f"こんにちは！{nickname}のあなた、何かお手伝いできることはありますか？😊"
 
+# 🧵 バックグラウンドワーカー起動
+start_webhook_workers()
+start_outbox_sender()
+start_chroma_preload()
+
 if __name__ == '__main__':
     # 環境変数が設定されているか確認
     print("=== 環境変数チェック ===")
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""PDFごとに分かれたChromaコレクション（chroma_db/<サブパス>/<PDF>）を1つのコレクションにまとめる
+
+各チャンクには scope（self / partner / gender / common）・mbti・gender・source_pdf のメタデータを付け、
+検索時は where フィルタで絞り込む。埋め込みは元のコレクションのものをそのまま使う（再計算しない）。
+
+実行:  python build_vector_index.py --src chroma_db --out chroma_db_unified
+"""
+import argparse
+import os
+import shutil
+import time
+
+import chromadb
+
+DEFAULT_SOURCE_DIR = "chroma_db"
+DEFAULT_OUTPUT_DIR = "chroma_db_unified"
+UNIFIED_COLLECTION_NAME = "lovehack_unified"
+# langchainのChromaが作るコレクションの既定名
+SOURCE_COLLECTION_NAME = "langchain"
+# 性別フォルダ名とプロフィールの性別の対応
+GENDER_DIRS = {"man": "男", "woman": "女"}
+BATCH_SIZE = 500
+
+def iter_source_dirs(src):
+    """(scope, mbti, gender, PDF名, パス) を列挙"""
+    for top in sorted(os.listdir(src)):
+        top_path = os.path.join(src, top)
+        if not os.path.isdir(top_path):
+            continue
+        if top in ("self", "partner"):
+            for mbti in sorted(os.listdir(top_path)):
+                mbti_path = os.path.join(top_path, mbti)
+                if not os.path.isdir(mbti_path):
+                    continue
+                for pdf_dir in sorted(os.listdir(mbti_path)):
+                    if os.path.isdir(os.path.join(mbti_path, pdf_dir)):
+                        yield top, mbti, "", pdf_dir, os.path.join(mbti_path, pdf_dir)
+        else:
+            scope = "gender" if top in GENDER_DIRS else top
+            for pdf_dir in sorted(os.listdir(top_path)):
+                if os.path.isdir(os.path.join(top_path, pdf_dir)):
+                    yield scope, "", GENDER_DIRS.get(top, ""), pdf_dir, os.path.join(top_path, pdf_dir)
+
+def build_unified_index(src=DEFAULT_SOURCE_DIR, out=DEFAULT_OUTPUT_DIR):
+    """統合コレクションを作成（一時ディレクトリに作ってから差し替える）。追加したチャンク数を返す"""
+    started = time.monotonic()
+    tmp = f"{out}.tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    client = chromadb.PersistentClient(path=tmp)
+    target = client.create_collection(UNIFIED_COLLECTION_NAME)
+    total = 0
+    for scope, mbti, gender, pdf_dir, path in iter_source_dirs(src):
+        try:
+            collection = chromadb.PersistentClient(path=path).get_collection(SOURCE_COLLECTION_NAME)
+        except ValueError:
+            print(f"スキップ（コレクションなし）: {path}")
+            continue
+        data = collection.get(include=["documents", "metadatas", "embeddings"])
+        count = len(data["ids"])
+        for start in range(0, count, BATCH_SIZE):
+            end = start + BATCH_SIZE
+            target.add(
+                ids=[f"{scope}/{mbti or gender or '-'}/{pdf_dir}/{chunk_id}" for chunk_id in data["ids"][start:end]],
+                documents=data["documents"][start:end],
+                embeddings=data["embeddings"][start:end],
+                metadatas=[
+                    {**(metadata or {}), "scope": scope, "mbti": mbti, "gender": gender, "source_pdf": pdf_dir}
+                    for metadata in data["metadatas"][start:end]
+                ]
+            )
+        total += count
+        print(f"{path}: {count}件")
+
+    # 書き込みが終わってから入れ替える（動作中のアプリが作りかけを読まないように）
+    old = f"{out}.old"
+    if os.path.exists(out):
+        os.replace(out, old)
+    os.replace(tmp, out)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    print(f"統合コレクションを作成しました: {out}（{total}件, {time.monotonic() - started:.1f}秒）")
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="ベクトルDBを1つのコレクションに統合")
+    parser.add_argument("--src", default=DEFAULT_SOURCE_DIR)
+    parser.add_argument("--out", default=DEFAULT_OUTPUT_DIR)
+    args = parser.parse_args()
+    if not os.path.isdir(args.src):
+        print(f"ベクトルDBが見つかりません: {args.src}")
+        return
+    build_unified_index(args.src, args.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""意図分類のローカル高速判定モデル（文字n-gramのナイーブベイズ）
+
+学習:  python intent_model.py train --log /data/logs/debug.log --out /data/intent_model.json
+評価:  python intent_model.py evaluate --log /data/logs/debug.log --model /data/intent_model.json
+"""
+import argparse
+import json
+import math
+import random
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+DEFAULT_LOG_PATH = "/data/logs/debug.log"
+DEFAULT_MODEL_PATH = "/data/intent_model.json"
+DEFAULT_THRESHOLD = 0.9
+# ローカルで判定してよいカテゴリ（挨拶・感謝・短い返事・雑談）
+LOCAL_INTENTS = {1, 2, 3, 5}
+NGRAM_SIZES = (1, 2, 3)
+
+# classify_message（と以前の classify_intent）がdebug.logに書いた行
+_INTENT_LOG_RE = re.compile(r"^\[classify_intent\] message: (.*), response: .*, result: (\d)\s*$")
+_MESSAGE_LOG_RE = re.compile(r"^\[classify_message\] message: (.*), response: .*, intent: (\d), question_type: \d\s*$")
+
+def normalize_text(text):
+    """NFKC正規化・小文字化・空白の除去"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", "", text)
+
+def extract_ngrams(text):
+    """文字n-gramを取り出す（先頭と末尾の目印付き）"""
+    padded = f"^{normalize_text(text)}$"
+    grams = []
+    for n in NGRAM_SIZES:
+        grams.extend(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+    return grams
+
+class IntentModel:
+    """多項ナイーブベイズによる意図分類モデル"""
+
+    def __init__(self, class_counts=None, feature_counts=None, alpha=1.0):
+        self.class_counts = class_counts or {}
+        self.feature_counts = feature_counts or {}
+        self.alpha = alpha
+        self._prepare()
+
+    def _prepare(self):
+        self.vocab_size = len({g for counts in self.feature_counts.values() for g in counts}) or 1
+        self.total_features = {label: sum(counts.values()) for label, counts in self.feature_counts.items()}
+        total = sum(self.class_counts.values()) or 1
+        self.log_priors = {label: math.log(count / total) for label, count in self.class_counts.items()}
+
+    @classmethod
+    def fit(cls, samples, alpha=1.0):
+        """(メッセージ, ラベル) のリストから学習"""
+        class_counts = Counter()
+        feature_counts = defaultdict(Counter)
+        for text, label in samples:
+            label = str(label)
+            class_counts[label] += 1
+            feature_counts[label].update(extract_ngrams(text))
+        return cls(dict(class_counts), {k: dict(v) for k, v in feature_counts.items()}, alpha)
+
+    def predict(self, text):
+        """(ラベル, 確率) を返す（学習データがなければ (None, 0.0)）"""
+        if not self.class_counts:
+            return None, 0.0
+        grams = extract_ngrams(text)
+        scores = {}
+        for label, log_prior in self.log_priors.items():
+            counts = self.feature_counts.get(label, {})
+            denom = self.total_features.get(label, 0) + self.alpha * self.vocab_size
+            scores[label] = log_prior + sum(math.log((counts.get(g, 0) + self.alpha) / denom) for g in grams)
+        best = max(scores, key=scores.get)
+        # log-sum-expで事後確率に正規化
+        top = scores[best]
+        norm = sum(math.exp(score - top) for score in scores.values())
+        return int(best), 1.0 / norm
+
+    def to_dict(self):
+        return {"alpha": self.alpha, "class_counts": self.class_counts, "feature_counts": self.feature_counts}
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["class_counts"], data["feature_counts"], data.get("alpha", 1.0))
+
+def load_training_samples(log_path):
+    """debug.logからLLMが付けた (メッセージ, 意図) を集める（同じメッセージは最新のラベルを使う）"""
+    labeled = {}
+    with open(log_path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            match = _INTENT_LOG_RE.match(line) or _MESSAGE_LOG_RE.match(line)
+            if match:
+                labeled[match.group(1)] = int(match.group(2))
+    return list(labeled.items())
+
+def evaluate(model, samples, threshold=DEFAULT_THRESHOLD):
+    """全体精度と、ローカル判定に回る割合（ヒット率）・その精度を計算"""
+    correct = 0
+    hits = 0
+    hit_correct = 0
+    for text, label in samples:
+        predicted, prob = model.predict(text)
+        correct += predicted == label
+        if predicted in LOCAL_INTENTS and prob >= threshold:
+            hits += 1
+            hit_correct += predicted == label
+    total = len(samples) or 1
+    return {
+        "samples": len(samples),
+        "accuracy": correct / total,
+        "hit_rate": hits / total,
+        "hit_precision": hit_correct / hits if hits else 0.0,
+        "threshold": threshold
+    }
+
+def print_report(title, report):
+    print(f"--- {title} ---")
+    print(f"サンプル数: {report['samples']}")
+    print(f"全体精度: {report['accuracy']:.3f}")
+    print(f"ローカル判定率（閾値 {report['threshold']}）: {report['hit_rate']:.3f}")
+    print(f"ローカル判定の精度: {report['hit_precision']:.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="意図分類ローカルモデルの学習・評価")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train_parser = sub.add_parser("train")
+    train_parser.add_argument("--log", default=DEFAULT_LOG_PATH)
+    train_parser.add_argument("--out", default=DEFAULT_MODEL_PATH)
+    train_parser.add_argument("--holdout", type=float, default=0.2)
+    train_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    eval_parser = sub.add_parser("evaluate")
+    eval_parser.add_argument("--log", default=DEFAULT_LOG_PATH)
+    eval_parser.add_argument("--model", default=DEFAULT_MODEL_PATH)
+    eval_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    samples = load_training_samples(args.log)
+    if not samples:
+        print(f"学習データが見つかりません: {args.log}")
+        return
+
+    if args.command == "train":
+        random.Random(0).shuffle(samples)
+        split = int(len(samples) * (1 - args.holdout))
+        if 0 < split < len(samples):
+            print_report("ホールドアウト評価", evaluate(IntentModel.fit(samples[:split]), samples[split:], args.threshold))
+        # 本番用モデルは全データで学習する
+        model = IntentModel.fit(samples)
+        model.save(args.out)
+        print(f"モデルを保存しました: {args.out}（{len(samples)}件）")
+    else:
+        print_report("評価", evaluate(IntentModel.load(args.model), samples, args.threshold))
+
+if __name__ == "__main__":
+    main()
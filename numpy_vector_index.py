@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""chroma_db の埋め込みをNumPyの行列に書き出し、プロセス内で検索するインデックス
+
+書き出すもの（出力ディレクトリ）:
+  embeddings.npy  正規化済みの埋め込み（float16, 行数 × 次元）。起動時はmmapで読む
+  meta.json       各行の本文・メタデータと、サブパス（self/INTJ, common など）ごとの行範囲
+
+検索はサブパスごとのコサイン類似度top-k（複数の質問をまとめて行列積で計算）。
+OpenAIの埋め込みは長さ1なので、ChromaのL2距離の順位とコサイン類似度の順位は一致する。
+
+書き出し:    python numpy_vector_index.py export --src chroma_db --out vector_index
+比較・計測:  python numpy_vector_index.py benchmark --src chroma_db --index vector_index
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import time
+
+import chromadb
+import numpy as np
+
+from build_vector_index import DEFAULT_SOURCE_DIR, SOURCE_COLLECTION_NAME
+
+DEFAULT_INDEX_DIR = "vector_index"
+EMBEDDINGS_FILE = "embeddings.npy"
+META_FILE = "meta.json"
+
+def iter_sub_paths(src):
+    """(サブパス, PDF名, パス) を列挙（サブパスはアプリの vector_sub_paths と同じ形）"""
+    for top in sorted(os.listdir(src)):
+        top_path = os.path.join(src, top)
+        if not os.path.isdir(top_path):
+            continue
+        subs = [top]
+        if top in ("self", "partner"):
+            subs = [f"{top}/{mbti}" for mbti in sorted(os.listdir(top_path)) if os.path.isdir(os.path.join(top_path, mbti))]
+        for sub in subs:
+            sub_path = os.path.join(src, sub)
+            for pdf_dir in sorted(os.listdir(sub_path)):
+                if os.path.isdir(os.path.join(sub_path, pdf_dir)):
+                    yield sub, pdf_dir, os.path.join(sub_path, pdf_dir)
+
+def _open_source_collection(path):
+    return chromadb.PersistentClient(path=path).get_collection(SOURCE_COLLECTION_NAME)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def export_index(src=DEFAULT_SOURCE_DIR, out=DEFAULT_INDEX_DIR):
+    """chroma_db を行列 + メタデータに書き出す（同じサブパスの行が連続するように並べる）。書き出した行数を返す"""
+    started = time.monotonic()
+    blocks = []
+    rows = []
+    offsets = {}
+    total = 0
+    for sub, pdf_dir, path in iter_sub_paths(src):
+        try:
+            collection = _open_source_collection(path)
+        except ValueError:
+            print(f"スキップ（コレクションなし）: {path}")
+            continue
+        data = collection.get(include=["documents", "metadatas", "embeddings"])
+        count = len(data["ids"])
+        if not count:
+            continue
+        blocks.append(np.asarray(data["embeddings"], dtype=np.float32))
+        for chunk_id, document, metadata in zip(data["ids"], data["documents"], data["metadatas"]):
+            rows.append({"id": f"{sub}/{pdf_dir}/{chunk_id}", "text": document, "metadata": {**(metadata or {}), "source_pdf": pdf_dir}})
+        start, _ = offsets.get(sub, (total, total))
+        offsets[sub] = (start, total + count)
+        total += count
+        print(f"{path}: {count}件")
+
+    matrix = normalize_rows(np.concatenate(blocks)) if blocks else np.zeros((0, 0), dtype=np.float32)
+    # 書き終わってから入れ替える（動作中のアプリが作りかけを読まないように）
+    tmp = f"{out}.tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, EMBEDDINGS_FILE), matrix.astype(np.float16))
+    with open(os.path.join(tmp, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"offsets": offsets, "rows": rows}, f, ensure_ascii=False)
+    old = f"{out}.old"
+    if os.path.exists(out):
+        os.replace(out, old)
+    os.replace(tmp, out)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    print(f"インデックスを書き出しました: {out}（{total}件, {time.monotonic() - started:.1f}秒）")
+    return total
+
+class NumpyVectorIndex:
+    """mmapした埋め込み行列をサブパスの行範囲で絞ってtop-k検索する"""
+
+    def __init__(self, path):
+        self.path = path
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.offsets = {sub: tuple(span) for sub, span in meta["offsets"].items()}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, query_vectors, k, subs):
+        """質問ベクトル（1本または複数）ごとに、各サブパスの上位k件を [{サブパス: [(行番号, 類似度)]}] で返す"""
+        queries = normalize_rows(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        results = [{} for _ in range(len(queries))]
+        for sub in subs:
+            start, end = self.offsets.get(sub, (0, 0))
+            if start >= end:
+                continue
+            # 行範囲ごとに float32 に広げてから行列積（全体を一度に広げない）
+            scores = queries @ np.asarray(self.embeddings[start:end], dtype=np.float32).T
+            top = min(k, end - start)
+            candidates = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            for i, row_scores in enumerate(scores):
+                picked = candidates[i][np.argsort(-row_scores[candidates[i]], kind="stable")]
+                results[i][sub] = [(start + int(j), float(row_scores[j])) for j in picked]
+        return results
+
+def current_rss_mb():
+    """現在の常駐メモリ（MB, Linuxのみ）"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))] if values else 0.0
+
+def benchmark(src, index_path, queries=50, k=4):
+    """保存済みの埋め込みを質問にして、Chromaとの結果一致率・レイテンシ・メモリを比較"""
+    rss_before = current_rss_mb()
+    started = time.monotonic()
+    index = NumpyVectorIndex(index_path)
+    print(f"NumPy: 読み込み {time.monotonic() - started:.2f}秒, RSS +{current_rss_mb() - rss_before:.0f}MB（{len(index)}件）")
+
+    rss_before = current_rss_mb()
+    started = time.monotonic()
+    collections = {}
+    for sub, pdf_dir, path in iter_sub_paths(src):
+        try:
+            collections.setdefault(sub, []).append((pdf_dir, _open_source_collection(path)))
+        except ValueError:
+            continue
+    print(f"Chroma: 読み込み {time.monotonic() - started:.2f}秒, RSS +{current_rss_mb() - rss_before:.0f}MB")
+
+    rng = random.Random(0)
+    samples = rng.sample(range(len(index)), min(queries, len(index)))
+    numpy_times = []
+    chroma_times = []
+    matched = 0
+    compared = 0
+    for row in samples:
+        sub = next(s for s, (start, end) in index.offsets.items() if start <= row < end)
+        vector = np.asarray(index.embeddings[row], dtype=np.float32)
+
+        started = time.monotonic()
+        numpy_ids = {index.rows[j]["id"] for j, _ in index.search(vector, k, [sub])[0].get(sub, [])}
+        numpy_times.append(time.monotonic() - started)
+
+        # Chromaは同じサブパスのPDFごとに検索して距離順にまとめる
+        started = time.monotonic()
+        hits = []
+        for pdf_dir, collection in collections.get(sub, []):
+            result = collection.query(query_embeddings=[vector.tolist()], n_results=k)
+            hits.extend((distance, f"{sub}/{pdf_dir}/{chunk_id}") for chunk_id, distance in zip(result["ids"][0], result["distances"][0]))
+        chroma_times.append(time.monotonic() - started)
+        chroma_ids = {chunk_id for _, chunk_id in sorted(hits)[:k]}
+
+        matched += len(numpy_ids & chroma_ids)
+        compared += len(chroma_ids)
+
+    print(f"一致率（top-{k}の重なり）: {matched / compared if compared else 0.0:.3f}")
+    print(f"NumPy  p50 {_percentile(numpy_times, 0.5) * 1000:.2f}ms / p95 {_percentile(numpy_times, 0.95) * 1000:.2f}ms")
+    print(f"Chroma p50 {_percentile(chroma_times, 0.5) * 1000:.2f}ms / p95 {_percentile(chroma_times, 0.95) * 1000:.2f}ms")
+
+    # まとめて検索した場合（複数の質問を1回の行列積で）
+    vectors = np.asarray(index.embeddings[samples], dtype=np.float32)
+    started = time.monotonic()
+    index.search(vectors, k, list(index.offsets))
+    print(f"NumPy バッチ検索（{len(samples)}問 × 全サブパス）: {(time.monotonic() - started) * 1000:.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="NumPyベクトルインデックスの書き出し・比較")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_parser = sub.add_parser("export")
+    export_parser.add_argument("--src", default=DEFAULT_SOURCE_DIR)
+    export_parser.add_argument("--out", default=DEFAULT_INDEX_DIR)
+    bench_parser = sub.add_parser("benchmark")
+    bench_parser.add_argument("--src", default=DEFAULT_SOURCE_DIR)
+    bench_parser.add_argument("--index", default=DEFAULT_INDEX_DIR)
+    bench_parser.add_argument("--queries", type=int, default=50)
+    bench_parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.src):
+        print(f"ベクトルDBが見つかりません: {args.src}")
+        return
+    if args.command == "export":
+        export_index(args.src, args.out)
+    else:
+        benchmark(args.src, args.index, args.queries, args.k)
+
+if __name__ == "__main__":
+    main()